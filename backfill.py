@@ -0,0 +1,150 @@
+import argparse
+import datetime as dt
+import json
+import os
+from time import monotonic
+
+import pandas as pd
+
+from rustalert import get_session, list_bins, get_bin_ml, get_class_counts, fetch_bins
+from cache import BinCache
+from statefiles import atomic_open
+
+PERIODS = {'day': ('D', '%Y-%m-%d'), 'week': ('W', '%Y-%m-%d'), 'month': ('M', '%Y-%m')}
+
+
+def list_range(args, session):
+    # every bin from args.start to args.end, paging args.list_chunk hours at a time
+    chunks = []
+    start = args.start
+    while start < args.end:
+        end = min(start+dt.timedelta(hours=args.list_chunk), args.end)
+        chunk = list_bins(args.dashboard, args.dataset, args.ifcb, start_date=start, end_date=end,
+                          session=session, timeout=args.http_timeout)
+        if not chunk.empty:
+            chunks.append(chunk)
+        start = end
+    if not chunks:
+        return pd.DataFrame(columns=['sample_time'])
+    bins = pd.concat(chunks)
+    bins = bins[~bins.index.duplicated()]
+    return bins[(bins['sample_time'] >= args.start) & (bins['sample_time'] < args.end)].sort_values('sample_time')
+
+
+def fetch_bin(args, session, cache, bin_id):
+    # ml_analyzed and every class's count for one bin. Cached just as update_datafile caches them,
+    # so backfills and live runs share each other's downloads
+    def meta():
+        return get_bin_ml(args.dashboard, bin_id, session=session, timeout=args.http_timeout)
+    def counts():
+        counts_series = get_class_counts(args.dashboard, args.dataset, bin_id, session=session, timeout=args.http_timeout)
+        return {taxon: int(count) for taxon, count in counts_series.items()}
+    return cache.fetch('meta', bin_id, meta), cache.fetch(f'counts/{args.dataset}', bin_id, counts)
+
+
+def partition_table(bins, results, taxa=None):
+    # one row per bin: sample_time, bin_ml and a count and perL column per taxon (default every class).
+    # Bins that could not be fetched are kept with empty values
+    ml = pd.Series({bin_id: ml for bin_id, (ml, counts) in results.items()}, dtype=float)
+    counts = pd.DataFrame.from_dict({bin_id: counts for bin_id, (ml, counts) in results.items()}, orient='index')
+    if taxa is None:
+        taxa = sorted(counts.columns)
+    counts = counts.reindex(columns=taxa).fillna(0)
+    perL = 1000*counts.div(ml, axis=0)
+    columns = [s for taxon in taxa for s in [counts[taxon].rename(f'{taxon}_count'), perL[taxon].rename(f'{taxon}_perL')]]
+    df = pd.concat([bins['sample_time'], ml.rename('bin_ml')]+columns, axis=1).reindex(bins.index)
+    df.index.name = 'pid'
+    return df
+
+
+def backfill(args):
+    # fetch and count every bin in the date range, one partition at a time. Each finished
+    # partition is written out and checkpointed in the manifest, so an interrupted backfill
+    # resumes at the first unfinished partition. Within a partition, bins already fetched
+    # are served from the bin cache
+    os.makedirs(args.output, exist_ok=True)
+    manifest_file = os.path.join(args.output, 'backfill.json')
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    session = get_session(args.workers, args.rate_limit)
+    cache = BinCache(args.cache_dir, max_mb=None, max_attempts=args.max_attempts, retry_minutes=args.retry_minutes)
+    freq, label_fmt = PERIODS[args.partition]
+    # a partition is only done for the taxa it was counted for, a new --taxa redoes it from the cache
+    taxa = sorted(args.taxa) if args.taxa else 'all'
+
+    bins = list_range(args, session)
+    print(f'{len(bins)} bins from {args.start:%Y-%m-%d} to {args.end:%Y-%m-%d}')
+    if bins.empty:
+        return manifest
+    periods = bins['sample_time'].dt.tz_convert(None).dt.to_period(freq)
+    for period, part in bins.groupby(periods):
+        label = period.start_time.strftime(label_fmt)
+        fname = os.path.join(args.output, f'{args.dataset}_{args.ifcb}_{label}.csv')
+        done = manifest.get(label)
+        if (done and done['failed'] == 0 and done['bins'] == len(part) and done.get('taxa') == taxa
+                and os.path.isfile(fname) and not args.overwrite):
+            print(f'{label}: done, skipping')
+            continue
+
+        start = monotonic()
+        results = fetch_bins(lambda bin_id: fetch_bin(args, session, cache, bin_id), part.index, args.workers,
+                             verbose=args.v >= 2, fmt=lambda result: f'{result[0]} ml')
+        df = partition_table(part, results, args.taxa)
+        with atomic_open(fname) as f:
+            df.to_csv(f)
+        secs = monotonic()-start
+
+        manifest[label] = dict(file=os.path.basename(fname), bins=len(part), failed=len(part)-len(results), taxa=taxa,
+                               written=dt.datetime.now(dt.timezone.utc).isoformat(timespec='seconds'))
+        with atomic_open(manifest_file) as f:
+            json.dump(manifest, f, indent=1)
+        print(f'{label}: {len(results)}/{len(part)} bins in {secs:.1f}s ({len(part)/secs:.1f} bins/s) -> {fname}')
+    return manifest
+
+
+def utc_date(value):
+    date = pd.Timestamp(value)
+    return (date.tz_localize('UTC') if date.tzinfo is None else date.tz_convert('UTC')).to_pydatetime()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reprocess a date range of bins into per-taxon counts, eg to build a series like '
+                                                 'demo/Margalefidinium_2017.csv for a new taxon or a past season.')
+    parser.add_argument('-v', '--verbose', dest='v', action='count', default=0)
+    parser.add_argument('--dashboard', metavar='URL', required=True, help='The target ifcb dashboard url.')
+    parser.add_argument('--dataset', required=True, help='An ifcb dataset.')
+    parser.add_argument('--ifcb', metavar='ID', required=True, help='Instrument to pull data from.')
+    parser.add_argument('--start', metavar='DATE', type=utc_date, required=True, help='First day (or time) to include, in UTC')
+    parser.add_argument('--end', metavar='DATE', type=utc_date, required=True, help='Day (or time) to stop before, in UTC')
+    parser.add_argument('--taxa', metavar='TAXON', nargs='+',
+        help='Taxa to count. Default is every class in the class scores')
+    parser.add_argument('--output', metavar='DIR', default='data/backfill',
+        help='Directory for the output files, one csv per --partition, and the backfill.json checkpoint. Default is "data/backfill"')
+    parser.add_argument('--partition', choices=PERIODS, default='month',
+        help='Period per output file. Default is "month"')
+    parser.add_argument('--overwrite', action='store_true', help='Redo partitions already completed')
+    parser.add_argument('--workers', metavar='N', default=16, type=int,
+        help='Maximum number of concurrent dashboard requests. Default is "16"')
+    parser.add_argument('--http-timeout', metavar='SECS', default=30, type=float)
+    parser.add_argument('--rate-limit', metavar='N', type=float,
+        help='Most requests per second to the dashboard. Default is no limit')
+    parser.add_argument('--list-chunk', metavar='HOURS', default=24*7, type=float,
+        help='Span of bins to list per dashboard request. Default is "168" hours')
+    parser.add_argument('--cache-dir', metavar='DIR', default='data/cache',
+        help='Bin cache, shared with rustalert.py, "none" to disable. Default is "data/cache"')
+    parser.add_argument('--retry-minutes', metavar='MINUTES', default=2, type=float)
+    parser.add_argument('--max-attempts', metavar='N', default=12, type=int)
+    args = parser.parse_args()
+
+    if not args.dashboard.startswith(('https://', 'http://')):
+        args.dashboard = 'https://'+args.dashboard
+    if args.cache_dir.lower() in ['none', '0']:
+        args.cache_dir = None
+    start = monotonic()
+    manifest = backfill(args)
+    bins = sum(part['bins'] for part in manifest.values())
+    failed = sum(part['failed'] for part in manifest.values())
+    print(f'{len(manifest)} partitions, {bins} bins, {failed} failed, in {monotonic()-start:.0f}s')
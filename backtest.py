@@ -0,0 +1,124 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product, repeat
+
+import numpy as np
+import pandas as pd
+
+from rustalert import pump_step
+from triggers import MODES, trigger_signal
+
+
+def load_series(fname, column='taxon_perL'):
+    # a datafile (or demo csv) as a perL series indexed by sample_time
+    df = pd.read_csv(fname, index_col='pid', parse_dates=['sample_time'])
+    df = df.dropna(subset=[column]).sort_values('sample_time')
+    return pd.Series(df[column].to_numpy(), index=pd.DatetimeIndex(df['sample_time']), name=column)
+
+
+def replay(series, threshold, timer, threshold_off=None):
+    # pump-off state after each bin, stepping through check_datafile's own pump_step
+    off = np.zeros(len(series), dtype=bool)
+    pump_timer = None
+    for i, (sample_time, signal) in enumerate(zip(series.index, series.to_numpy())):
+        event, pump_timer = pump_step(signal, sample_time, pump_timer, threshold, timer, threshold_off)
+        off[i] = pump_timer is not None
+    return off
+
+
+def pump_off_mask(series, threshold, timer):
+    # vectorized equivalent of replay(): the pump is off while the latest bin
+    # above threshold is no more than `timer` hours older than the current bin
+    times = series.index.to_series()
+    last_above = times.where(series.to_numpy() > threshold).ffill()
+    return (times-last_above <= pd.Timedelta(hours=timer)).to_numpy()
+
+
+def score(series, off, reference):
+    # pump-off hours, outlet toggles and detection lags for one pump-off mask.
+    # Detection lag is measured from the first bin of each run of bins above `reference`
+    # to the first bin of that run with the pump off. Runs never caught are missed
+    times = series.index
+    change = np.diff(off.astype(int), prepend=0, append=0)
+    off_starts = times[change[:-1] == 1]
+    off_ends = times[np.minimum(np.flatnonzero(change == -1), len(times)-1)]
+    pump_off_hours = np.sum((off_ends-off_starts).total_seconds())/3600
+
+    above = np.concatenate([[False], series.to_numpy() > reference, [False]])
+    run_starts = np.flatnonzero(~above[:-1] & above[1:])
+    run_ends = np.flatnonzero(above[:-1] & ~above[1:])
+    offs = np.flatnonzero(off)
+    first_off = np.searchsorted(offs, run_starts)
+    caught = first_off < len(offs)
+    caught[caught] = offs[first_off[caught]] < run_ends[caught]
+    lags = np.asarray((times[offs[first_off[caught]]]-times[run_starts[caught]]).total_seconds())/3600
+
+    return dict(pump_off_hours=pump_off_hours, toggles=int(np.abs(change).sum()),
+                lags=list(lags), missed=int((~caught).sum()))
+
+
+def evaluate(serieses, threshold, timer, reference, exact=False, threshold_off=None):
+    # score one threshold/timer setting, summed over several separate series (eg seasons).
+    # serieses are (perL, trigger signal) pairs. Hysteresis is path dependent, so always exact
+    row = dict(threshold=threshold, timer=timer, pump_off_hours=0., toggles=0, missed=0)
+    lags = []
+    for series, signal in serieses:
+        if exact or threshold_off is not None:
+            off = replay(signal, threshold, timer, threshold_off)
+        else:
+            off = pump_off_mask(signal, threshold, timer)
+        result = score(series, off, reference)
+        lags += result.pop('lags')
+        for key, value in result.items():
+            row[key] += value
+    row['mean_lag_hours'] = np.mean(lags) if lags else float('nan')
+    row['max_lag_hours'] = np.max(lags) if lags else float('nan')
+    return row
+
+
+def sweep(serieses, thresholds, timers, reference=None, exact=False, workers=None,
+          trigger='last', window=3, threshold_off=None):
+    # evaluate every threshold x timer setting. Exact replays are spread across a process pool
+    if reference is None:
+        reference = min(thresholds)
+    serieses = [(series, trigger_signal(series, trigger, window)) for series in serieses]
+    grid = list(product(thresholds, timers))
+    thresholds, timers = [t for t, _ in grid], [t for _, t in grid]
+    args = (repeat(serieses), thresholds, timers, repeat(reference), repeat(exact), repeat(threshold_off))
+    if exact or threshold_off is not None:
+        with ProcessPoolExecutor(workers) as pool:
+            rows = list(pool.map(evaluate, *args, chunksize=max(1, len(grid)//(4*(workers or 4)))))
+    else:
+        rows = list(map(evaluate, *args))
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay historical counts to tune --threshold and --timer.')
+    parser.add_argument('files', metavar='CSV', nargs='+',
+        help='Datafiles with sample_time and a perL column, eg demo/Margalefidinium_2017.csv. '
+             'Each file is replayed separately')
+    parser.add_argument('--column', default='taxon_perL',
+        help='Column of per-liter counts. Default is "taxon_perL"')
+    parser.add_argument('--thresholds', metavar='PER_L', nargs='+', type=float, required=True)
+    parser.add_argument('--timers', metavar='HOURS', nargs='+', type=float, default=[1.5])
+    parser.add_argument('--trigger', choices=MODES, default='last',
+        help='Trigger mode, as in rustalert.py. Default is "last"')
+    parser.add_argument('--window', metavar='BINS', type=int, default=3,
+        help='Number of bins for --trigger modes other than "last". Default is "3"')
+    parser.add_argument('--threshold-off', metavar='PER_L', type=float,
+        help='Hysteresis threshold, as in rustalert.py. Replays are then always --exact')
+    parser.add_argument('--reference', metavar='PER_L', type=float,
+        help='Counts considered a bloom when measuring detection lag. Default is the lowest threshold')
+    parser.add_argument('--exact', action='store_true',
+        help='Step through the live pump_step logic bin by bin (in a process pool) instead of the vectorized replay')
+    parser.add_argument('--workers', metavar='N', type=int)
+    parser.add_argument('--output', metavar='CSV', help='Also save the results table to this file')
+    args = parser.parse_args()
+
+    serieses = [load_series(fn, args.column) for fn in args.files]
+    results = sweep(serieses, args.thresholds, args.timers, args.reference, args.exact, args.workers,
+                    args.trigger, args.window, args.threshold_off)
+    print(results.to_string(index=False, float_format='{:.2f}'.format))
+    if args.output:
+        results.to_csv(args.output, index=False)
@@ -0,0 +1,166 @@
+import argparse
+import datetime as dt
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import rustalert
+from plotting import plot4email
+from storage import open_store
+from mock_dashboard import MockIFCB, serve
+
+
+def measure(func, *args, trace=False, **kwargs):
+    # run func once, returning its result, wall time in seconds and, if traced, peak memory in MB.
+    # tracemalloc slows allocation heavy code down a lot, so traced timings are not comparable
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    secs = time.perf_counter()-start
+    peak = tracemalloc.get_traced_memory()[1]/1e6 if trace else None
+    if trace:
+        tracemalloc.stop()
+    return result, secs, peak
+
+
+def timings(func, *args, repeat=5, **kwargs):
+    # peak memory of one traced run, then the first and best wall times of `repeat` untraced runs
+    _, _, peak = measure(func, *args, trace=True, **kwargs)
+    secs = [measure(func, *args, **kwargs)[1] for i in range(repeat)]
+    return dict(ms_first=1000*secs[0], ms=1000*min(secs), peak_mb=peak)
+
+
+def make_rule(tmp, url, ext='.csv', extra=()):
+    # a rustalert rule pointed at the mock dashboard and powerstrip, with its files in tmp
+    parser = rustalert.make_parser()
+    args = parser.parse_args([
+        '--dashboard', url, '--dataset', 'bench', '--ifcb', 'IFCB999', '--threshold', '50000',
+        '--powerstrip', url, '--pump-outlet', '1', '--aerator-outlet', '2', '--plotfile', '',
+        '--cache-dir', 'none', '--fetch-limit', '0', '--datafile', f'{tmp}/{{TAXON}}{ext}', '--logfile', f'{tmp}/{{TAXON}}.pumplog.csv',
+        '--timerfile', f'{tmp}/{{TAXON}}.pumptimer.txt', '--cursorfile', f'{tmp}/{{TAXON}}.cursor.txt', *extra])
+    rules, cache = rustalert.setup(args, parser)
+    return rules[0]
+
+
+def seed_backlog(mock, rule, hours):
+    # make rule's next update catch up on `hours` of bins, as after an outage
+    start = next(mock.bins(dt.datetime.now(dt.timezone.utc)-dt.timedelta(hours=hours)))
+    store = open_store(rule.datafile)
+    store.add_bins(pd.DataFrame({'sample_time': [pd.Timestamp(start)]}, index=pd.Index([mock.pid(start)], name='pid')))
+    store.save()
+    rustalert.set_poll_cursor(rule.cursorfile, start)
+
+
+def bench_parse(classes, rois, bins):
+    # get_class_counts per bin, against class and roi counts
+    mock = MockIFCB(classes=classes, rois=rois)
+    server, url = serve(mock)
+    session = rustalert.get_session()
+    pids = [mock.pid(t) for t in mock.bins(dt.datetime.now(dt.timezone.utc)-bins*mock.interval)][:bins]
+    for pid in pids:
+        mock.class_scores(pid)  # generate ahead, so only parsing is timed
+    _, _, peak = measure(rustalert.get_class_counts, url, 'bench', pids[0], session=session, trace=True)
+    _, secs, _ = measure(lambda: [rustalert.get_class_counts(url, 'bench', pid, session=session) for pid in pids])
+    server.shutdown()
+    return dict(stage='get_class_counts', classes=classes, rois=rois, bins=len(pids),
+                ms_per_bin=1000*secs/len(pids), peak_mb=peak)
+
+
+def bench_pipeline(args):
+    # update_datafile catching up on a backlog, steady state check_datafile and plot4email,
+    # and detection-to-actuation latency for a newly published bloom bin
+    results = []
+    mock = MockIFCB(classes=args.classes[0], rois=args.rois[0], interval=args.interval,
+                    latency=args.latency, error_rate=args.error_rate, unclassified=args.unclassified)
+    server, url = serve(mock)
+    now = dt.datetime.now(dt.timezone.utc)
+    times = list(mock.bins(now-dt.timedelta(hours=args.hours)))
+    mock.published_until = times[-1-args.repeat]
+    for t in times[:-args.repeat]:
+        mock.class_scores(mock.pid(t))  # generate ahead, so only the pipeline is timed
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rule = make_rule(tmp, url, args.store)
+        seed_backlog(mock, rule, args.hours)
+        store = open_store(rule.datafile)
+        session = rustalert.get_session(rule.workers)
+        state = {}
+
+        requests_before = mock.requests
+        _, secs, _ = measure(rustalert.update_datafile, rule, session, store)
+        bins = len(store.read())
+        results.append(dict(stage='update_datafile', bins=bins, workers=rule.workers, secs=secs,
+                            bins_per_sec=bins/secs, requests=mock.requests-requests_before))
+
+        results.append(dict(stage='check_datafile', **timings(rustalert.check_datafile, rule, store, state, repeat=args.repeat)))
+
+        df_bins, df_log = store.read(), state['log']
+        results.append(dict(stage='plot4email', **timings(plot4email, df_bins, df_log, rule.threshold, ago_limit=1,
+                                                          output=f'{tmp}/plot.png', repeat=args.repeat)))
+
+        # publish one bloom bin at a time and time how long until the pump outlet is switched off
+        latencies = []
+        for t in times[-args.repeat:]:
+            mock.bloom_after = t
+            mock.class_scores(mock.pid(t))
+            mock.published_until = t
+            mock.outlets.clear()
+            rustalert.set_pump_timer(rule.timerfile, None)
+            state['timer'] = None
+            start = time.monotonic()
+            rustalert.update_datafile(rule, session, store)
+            rustalert.check_datafile(rule, store, state)
+            off = [when for when, outlet, on in mock.outlet_events if when >= start and outlet == rule.pump_outlet and not on]
+            if off:
+                latencies.append(off[0]-start)
+        results.append(dict(stage='detection_to_actuation', runs=args.repeat, detected=len(latencies),
+                            ms=1000*min(latencies) if latencies else float('nan'),
+                            ms_max=1000*max(latencies) if latencies else float('nan')))
+    server.shutdown()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the rustalert pipeline against a local mock dashboard and powerstrip.')
+    parser.add_argument('--classes', metavar='N', nargs='+', type=int, default=[10, 50, 100],
+        help='Class counts for the parsing benchmark, the first is used for the pipeline. Default is "10 50 100"')
+    parser.add_argument('--rois', metavar='N', nargs='+', type=int, default=[1000, 5000],
+        help='Rois per bin for the parsing benchmark, the first is used for the pipeline. Default is "1000 5000"')
+    parser.add_argument('--parse-bins', metavar='N', type=int, default=10)
+    parser.add_argument('--hours', type=float, default=24,
+        help='Backlog of bins for update_datafile to catch up on. Default is "24" hours')
+    parser.add_argument('--interval', metavar='MINUTES', type=float, default=5,
+        help='Minutes between mock bins. Default is "5"')
+    parser.add_argument('--store', choices=['.csv', '.sqlite'], default='.csv')
+    parser.add_argument('--latency', metavar='SECS', type=float, default=0.02,
+        help='Latency added to every mock request. Default is "0.02"')
+    parser.add_argument('--error-rate', type=float, default=0.,
+        help='Fraction of mock requests answered with a 503')
+    parser.add_argument('--unclassified', type=float, default=0.,
+        help='Fraction of mock bins without class scores')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', metavar='FILE', help='Append the results to this file as json lines')
+    args = parser.parse_args()
+
+    results = [bench_parse(classes, rois, args.parse_bins) for classes in args.classes for rois in args.rois]
+    results += bench_pipeline(args)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+    for stage in dict.fromkeys(result['stage'] for result in results):
+        rows = pd.DataFrame([result for result in results if result['stage'] == stage])
+        print(rows.to_string(index=False, float_format='{:.2f}'.format), end='\n\n')
+    print(f'max rss: {maxrss:.0f} MB')
+
+    if args.json:
+        stamp = dt.datetime.now(dt.timezone.utc).isoformat(timespec='seconds')
+        with open(args.json, 'a') as f:
+            for result in results:
+                f.write(json.dumps(dict(time=stamp, **result))+'\n')
@@ -0,0 +1,170 @@
+import datetime as dt
+import io
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+
+class MockIFCB:
+    # synthetic IFCB dashboard and relay powerstrip, for benchmarks.
+    # Bins are every `interval` minutes up to the current time (or `published_until`),
+    # each with `rois` rois scored against `classes` classes. Bins from `bloom_after`
+    # on have `bloom` of their rois classified as `taxon`
+
+    def __init__(self, classes=50, rois=1000, interval=20, instrument='IFCB999', taxon='Margalefidinium',
+                 ml=3.5, latency=0., error_rate=0., unclassified=0., seed=0):
+        self.classes = [taxon]+[f'class_{i:03d}' for i in range(1, classes)]
+        self.rois = rois
+        self.interval = dt.timedelta(minutes=interval)
+        self.instrument = instrument
+        self.ml = ml
+        self.latency = latency
+        self.error_rate = error_rate
+        self.unclassified = unclassified
+        self.seed = seed
+        self.bloom_after = None
+        self.bloom = 0.5
+        self.published_until = None
+        self.outlets = {}
+        self.outlet_events = []  # (monotonic time, outlet, state)
+        self.requests = 0
+        self._scores = {}
+        self._lock = threading.Lock()
+
+    def pid(self, sample_time):
+        return sample_time.strftime(f'D%Y%m%dT%H%M%S_{self.instrument}')
+
+    def sample_time(self, pid):
+        return dt.datetime.strptime(pid[1:16], '%Y%m%dT%H%M%S').replace(tzinfo=dt.timezone.utc)
+
+    def bins(self, start, end=None):
+        end = min(end or dt.datetime.now(dt.timezone.utc), self.published_until or dt.datetime.max.replace(tzinfo=dt.timezone.utc))
+        epoch = dt.datetime(2000, 1, 1, tzinfo=dt.timezone.utc)
+        t = epoch + -(-(start-epoch)//self.interval)*self.interval
+        while t <= end:
+            yield t
+            t += self.interval
+
+    def is_classified(self, pid):
+        return random.Random(f'{self.seed}{pid}').random() >= self.unclassified
+
+    def class_scores(self, pid):
+        # csv of per-roi class scores, generated once per bin
+        with self._lock:
+            if pid not in self._scores:
+                rng = np.random.default_rng(zlib.crc32(f'{self.seed}{pid}'.encode()))
+                scores = rng.random((self.rois, len(self.classes)), dtype=np.float32)
+                if self.bloom_after and self.sample_time(pid) >= self.bloom_after:
+                    scores[:int(self.bloom*self.rois), 0] += 1
+                csv = io.StringIO()
+                csv.write('pid,'+','.join(self.classes)+'\n')
+                for i, row in enumerate(scores):
+                    csv.write(f'{pid}_{i+1:05d},')
+                    np.savetxt(csv, row[None], fmt='%.4f', delimiter=',')
+                self._scores[pid] = csv.getvalue()
+            return self._scores[pid]
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, body='', ctype='application/json', code=200):
+        body = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def injected(self):
+        mock = self.server.mock
+        mock.requests += 1
+        if mock.latency:
+            time.sleep(mock.latency)
+        if random.random() < mock.error_rate:
+            self.reply('{"error": "injected"}', code=503)
+            return True
+        return False
+
+    def do_GET(self):
+        mock = self.server.mock
+        if self.injected():
+            return
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/api/list_bins':
+            start = dt.datetime.fromisoformat(query['start_date'][0])
+            end = dt.datetime.fromisoformat(query['end_date'][0]) if 'end_date' in query else None
+            start = start if start.tzinfo else start.replace(tzinfo=dt.timezone.utc)
+            end = end if end is None or end.tzinfo else end.replace(tzinfo=dt.timezone.utc)
+            data = [dict(pid=mock.pid(t), sample_time=t.isoformat(), skip=False) for t in mock.bins(start, end)]
+            return self.reply(json.dumps(dict(data=data)))
+
+        m = re.fullmatch(r'/api/bin/(\w+)', url.path)
+        if m:
+            return self.reply(json.dumps(dict(pid=m.group(1), ml_analyzed=f'{mock.ml:.3f} ml')))
+
+        m = re.fullmatch(r'/[\w-]+/(\w+)_class_scores\.csv', url.path)
+        if m:
+            if not mock.is_classified(m.group(1)):
+                return self.reply('not found', 'text/plain', 404)
+            return self.reply(mock.class_scores(m.group(1)), 'text/csv')
+
+        m = re.fullmatch(r'/restapi/relay/outlets/(\d+)/physical_state/', url.path)
+        if m:
+            return self.reply(json.dumps(mock.outlets.get(int(m.group(1)), True)))
+
+        self.reply('not found', 'text/plain', 404)
+
+    def do_PUT(self):
+        mock = self.server.mock
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        if self.injected():
+            return
+        m = re.fullmatch(r'/restapi/relay/outlets/(\d+)/state/', self.path)
+        if not m:
+            return self.reply('not found', 'text/plain', 404)
+        state = 'value=true' in body
+        mock.outlets[int(m.group(1))] = state
+        mock.outlet_events.append((time.monotonic(), int(m.group(1)), state))
+        self.reply('', code=204)
+
+
+def serve(mock, port=0):
+    # serve the mock from a background thread, returns the server and its url
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.mock = mock
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve a synthetic IFCB dashboard and relay powerstrip.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--classes', type=int, default=50)
+    parser.add_argument('--rois', type=int, default=1000)
+    parser.add_argument('--latency', metavar='SECS', type=float, default=0.)
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--unclassified', type=float, default=0.)
+    parser.add_argument('--bloom-after', metavar='ISO_DATE', type=dt.datetime.fromisoformat)
+    args = parser.parse_args()
+    mock = MockIFCB(classes=args.classes, rois=args.rois, latency=args.latency,
+                    error_rate=args.error_rate, unclassified=args.unclassified)
+    if args.bloom_after and args.bloom_after.tzinfo is None:
+        args.bloom_after = args.bloom_after.replace(tzinfo=dt.timezone.utc)
+    mock.bloom_after = args.bloom_after
+    server, url = serve(mock, args.port)
+    print(f'Serving mock dashboard and powerstrip at {url}')
+    threading.Event().wait()
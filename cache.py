@@ -0,0 +1,151 @@
+import gzip
+import json
+import os
+import time
+
+from statefiles import atomic_open
+
+
+class Backoff(Exception):
+    # raised instead of re-fetching a bin whose last fetch failed too recently
+    pass
+
+
+class GaveUp(Backoff):
+    # raised for bins found Unclassified max_attempts times
+    pass
+
+
+class Unclassified(Exception):
+    # raised by fetch functions when the dashboard has no data for a bin, eg it was never classified.
+    # Only these count towards giving up on a bin, other failures such as timeouts are just retried
+    pass
+
+
+class BinCache:
+    # on-disk cache of per-bin results, one small gzipped json file per bin.
+    # A bin's ml_analyzed and class scores never change once classified, so entries
+    # never go stale and are only dropped to respect max_days and max_mb.
+    # Failed fetches are stored too and retried after an exponential backoff, until found Unclassified max_attempts times.
+    # With no root only the failures are kept, in memory, so backoff still works in --daemon mode
+
+    def __init__(self, root, max_mb=256, max_days=None, retry_minutes=2, retry_max_hours=24, max_attempts=12,
+                 evict_every=3600):
+        self.root = root
+        self.memory = {} if root is None else None
+        self.max_bytes = max_mb*1024*1024 if max_mb else None
+        self.max_age = max_days*86400 if max_days else None
+        self.retry = retry_minutes*60
+        self.retry_max = retry_max_hours*3600
+        self.max_attempts = max_attempts
+        self.evict_every = evict_every
+        self.last_evict = 0
+
+    def _path(self, kind, key):
+        if self.memory is not None:
+            return kind, key
+        return os.path.join(self.root, kind, f'{key}.json.gz')
+
+    def _read(self, path):
+        if self.memory is not None:
+            return self.memory.get(path)
+        try:
+            with gzip.open(path, 'rt') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, entry):
+        if self.memory is not None:
+            if 'value' in entry:
+                self.memory.pop(path, None)
+            else:
+                self.memory[path] = entry
+            return
+        # write-then-rename, so concurrent readers never see a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_open(path, 'wb') as f:
+            f.write(gzip.compress(json.dumps(entry).encode()))
+
+    def gave_up(self, entry):
+        return bool(self.max_attempts) and entry.get('misses', 0) >= self.max_attempts
+
+    def waiting(self, kind, key):
+        # whether key's last fetch failed and is still backing off, or was given up on
+        return self.due_at(kind, key) > time.time()
+
+    def due_at(self, kind, key):
+        # when key is next worth fetching, as a time.time(): 0 unless its last fetch failed, inf once given up on
+        entry = self._read(self._path(kind, key))
+        if entry is None or 'value' in entry:
+            return 0
+        return float('inf') if self.gave_up(entry) else entry['retry_after']
+
+    def fetch(self, kind, key, func, errors=Exception):
+        # return func()'s cached value, calling and caching it on a miss.
+        # Exceptions in `errors` are cached as failures and re-raised
+        path = self._path(kind, key)
+        entry = self._read(path)
+        if entry is not None:
+            if 'value' in entry:
+                return entry['value']
+            if self.gave_up(entry):
+                raise GaveUp(f'{entry["error"]} (gave up after {entry["misses"]} attempts)')
+            wait = entry['retry_after']-time.time()
+            if wait > 0:
+                raise Backoff(f'{entry["error"]} (attempt {entry["attempts"]}, retry in {round(wait/60)} min)')
+        try:
+            value = func()
+        except errors as e:
+            attempts = entry['attempts']+1 if entry else 1
+            misses = (entry.get('misses', 0) if entry else 0)+isinstance(e, Unclassified)
+            delay = min(self.retry*2**(attempts-1), self.retry_max)
+            self._write(path, dict(error=str(e) or type(e).__name__, attempts=attempts, misses=misses,
+                                   retry_after=time.time()+delay))
+            raise
+        self._write(path, dict(value=value))
+        return value
+
+    def evict(self, force=False):
+        # drop entries older than max_days, then the oldest entries until under max_mb.
+        # At most once per evict_every seconds, across runs too, as the stamp file's mtime
+        # records the last eviction. In memory only failures are kept, few enough to leave be
+        if self.memory is not None or not (self.max_age or self.max_bytes):
+            return
+        now = time.time()
+        stamp = os.path.join(self.root, '.evicted')
+        if not force:
+            try:
+                self.last_evict = max(self.last_evict, os.path.getmtime(stamp))
+            except OSError:
+                pass
+            if now-self.last_evict < self.evict_every:
+                return
+        self.last_evict = now
+        os.makedirs(self.root, exist_ok=True)
+        with open(stamp, 'a'):
+            pass
+        os.utime(stamp, (now, now))
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for fn in filenames:
+                if fn == '.evicted':
+                    continue
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        files.sort()
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in files:
+            too_old = self.max_age and now-mtime > self.max_age
+            too_big = self.max_bytes and total > self.max_bytes
+            if not (too_old or too_big):
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -1,12 +1,18 @@
 import os
+import time
+import uuid
+import threading
 import smtplib
-from email import encoders
+from email import encoders, message_from_bytes
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 
+from metrics import METRICS
+from statefiles import atomic_open
 
-def send_emails(TO, FROM="emailing.py", SUBJECT="", BODY="", SMTPserver='localhost', USER=None, PASS=None, attachements=()):
+
+def make_message(TO, FROM="emailing.py", SUBJECT="", BODY="", USER=None, attachements=()):
 
     if FROM=="emailing.py" and USER:
         FROM = USER
@@ -26,19 +32,150 @@ def send_emails(TO, FROM="emailing.py", SUBJECT="", BODY="", SMTPserver='localho
             encoders.encode_base64(part)
             part.add_header('Content-Disposition', f"attachment; filename= {os.path.basename(file_path)}")
             msg.attach(part)
+    return msg
+
 
+def connect(SMTPserver='localhost', USER=None, PASS=None, timeout=30):
     if SMTPserver == 'localhost':   # send mail from local server
         # Start local SMTP server
-        server = smtplib.SMTP(SMTPserver)
-        text = msg.as_string()
-        server.send_message(msg)
-    else:
-        # Start SMTP ssl server
-        server = smtplib.SMTP_SSL(SMTPserver)
-        # Enter login credentials for the email you want to sent mail from
-        server.login(USER, PASS)
-        text = msg.as_string()
-        # Send mail
-        server.sendmail(FROM, TO, text)
+        return smtplib.SMTP(SMTPserver, timeout=timeout)
+    # Start SMTP ssl server
+    server = smtplib.SMTP_SSL(SMTPserver, timeout=timeout)
+    # Enter login credentials for the email you want to sent mail from
+    server.login(USER, PASS)
+    return server
 
+
+def send_emails(TO, FROM="emailing.py", SUBJECT="", BODY="", SMTPserver='localhost', USER=None, PASS=None, attachements=()):
+    msg = make_message(TO, FROM, SUBJECT, BODY, USER, attachements)
+    server = connect(SMTPserver, USER, PASS)
+    server.send_message(msg)
     server.quit()
+
+
+def permanent(error):
+    # whether the server refused an email for good (5xx), rather than for now (4xx)
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, msg in error.recipients.values())
+    return error.smtp_code >= 500
+
+
+class Outbox:
+    # durable queue of outgoing emails, one .eml file each in `folder`.
+    # flush() sends every queued email over one reused SMTP connection, deleting each
+    # file once sent. On failure the rest stay queued and are retried with a backoff.
+    # Emails the server refuses outright (5xx) are moved to `folder`/dead, so they don't hold up the rest
+
+    def __init__(self, folder, SMTPserver='localhost', USER=None, PASS=None,
+                 retry_secs=30, retry_max_secs=3600, idle_secs=60):
+        self.folder = folder
+        self.smtp = dict(SMTPserver=SMTPserver, USER=USER, PASS=PASS)
+        self.retry_secs = retry_secs
+        self.retry_max_secs = retry_max_secs
+        self.idle_secs = idle_secs
+        self.server = None
+        self.last_used = 0
+        self.attempts = 0
+        self.next_try = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        os.makedirs(folder, exist_ok=True)
+
+    def put(self, TO, SUBJECT="", BODY="", attachements=(), FROM="emailing.py"):
+        # queue an email, attachments are read now so later changes to them don't matter
+        msg = make_message(TO, FROM, SUBJECT, BODY, self.smtp['USER'], attachements)
+        fname = os.path.join(self.folder, f'{time.time():.6f}-{uuid.uuid4().hex[:8]}.eml')
+        with atomic_open(fname, 'wb') as f:
+            f.write(msg.as_bytes())
+        self.wakeup.set()
+
+    def queued(self):
+        return sorted(fn for fn in os.listdir(self.folder) if fn.endswith('.eml'))
+
+    def _connection(self):
+        # reuse the open connection unless the server has dropped it
+        if self.server is not None:
+            try:
+                self.server.noop()
+                return self.server
+            except smtplib.SMTPException:
+                self.close()
+        self.server = connect(**self.smtp)
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def flush(self, force=False):
+        # send everything queued, returns the number of emails sent
+        with self.lock:
+            fnames = self.queued()
+            if not fnames or (not force and time.time() < self.next_try):
+                return 0
+            sent = dead = 0
+            try:
+                with METRICS.timer('smtp_seconds', step='connect'):
+                    server = self._connection()
+                for fn in fnames:
+                    path = os.path.join(self.folder, fn)
+                    try:
+                        with open(path, 'rb') as f, METRICS.timer('smtp_seconds', step='send'):
+                            server.send_message(message_from_bytes(f.read()))
+                    except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                        if not permanent(e):
+                            raise
+                        self.bury(fn, e)
+                        dead += 1
+                        continue
+                    os.remove(path)
+                    sent += 1
+                self.attempts = self.next_try = 0
+                self.last_used = time.time()
+            except (smtplib.SMTPException, OSError) as e:
+                METRICS.inc('email_failures_total', error=type(e).__name__)
+                self.close()
+                self.attempts += 1
+                delay = min(self.retry_secs*2**(self.attempts-1), self.retry_max_secs)
+                self.next_try = time.time()+delay
+                print(f'  ERROR: emailing {len(fnames)-sent-dead} queued alerts - {type(e).__name__} {e} (retrying in {delay}s)')
+            METRICS.inc('emails_sent_total', sent)
+            METRICS.set('outbox_queued', len(fnames)-sent-dead)
+            return sent
+
+    def bury(self, fn, error):
+        dead = os.path.join(self.folder, 'dead')
+        os.makedirs(dead, exist_ok=True)
+        os.replace(os.path.join(self.folder, fn), os.path.join(dead, fn))
+        METRICS.inc('emails_dead_total')
+        print(f'  ERROR: email {fn} refused - {type(error).__name__} {error}, moved to {dead}')
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(timeout=self.retry_secs)
+            self.wakeup.clear()
+            self.flush()
+            if self.server is not None and time.time()-self.last_used > self.idle_secs:
+                with self.lock:
+                    self.close()
+
+    def start(self):
+        # send queued emails from a background thread from now on
+        threading.Thread(target=self._run, name='outbox', daemon=True).start()
+        self.wakeup.set()
+
+
+_outboxes = {}
+
+def get_outbox(folder, SMTPserver='localhost', USER=None, PASS=None):
+    # one Outbox, and so one connection, per outbox folder. Whatever is queued in a folder is
+    # sent with its Outbox's login, so a folder can't be shared between logins
+    if folder not in _outboxes:
+        _outboxes[folder] = Outbox(folder, SMTPserver, USER, PASS)
+    elif _outboxes[folder].smtp != dict(SMTPserver=SMTPserver, USER=USER, PASS=PASS):
+        raise ValueError(f'outbox {folder} is already used with another SMTP server or login')
+    return _outboxes[folder]
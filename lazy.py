@@ -0,0 +1,17 @@
+import importlib
+
+
+class LazyModule:
+    # stands in for a module, importing it on first attribute access, so runs
+    # that never need pandas, numpy or requests don't pay for importing them
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self.__dict__['_name']), attr)
+        self.__dict__[attr] = value  # later lookups skip __getattr__
+        return value
+
+    def __repr__(self):
+        return f'<lazy module {self.__dict__["_name"]!r}>'
@@ -0,0 +1,139 @@
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from statefiles import atomic_open
+
+# upper bounds of the timing histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _json(value):
+    # NaN and inf, eg a trigger signal over too short a history, aren't valid json
+    return None if isinstance(value, float) and not math.isfinite(value) else value
+
+
+def _prom(value):
+    # Prometheus spells these NaN, +Inf and -Inf
+    if isinstance(value, float) and not math.isfinite(value):
+        return 'NaN' if math.isnan(value) else '+Inf' if value > 0 else '-Inf'
+    return value
+
+
+def _name(key):
+    name, labels = key
+    if not labels:
+        return name
+    return name+'{'+','.join(f'{k}="{v}"' for k, v in labels)+'}'
+
+
+class Metrics:
+    # counters, gauges and timing histograms, each keyed by name and labels.
+    # Observations since the last flush() go out as one json line, and are added
+    # to running totals written as a Prometheus text file (eg for node_exporter's textfile collector)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters, self.gauges, self.histograms = {}, {}, {}
+        self.totals = {}, {}, {}
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0)+value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, secs, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = dict(count=0, sum=0., max=0., buckets=[0]*len(BUCKETS))
+            h['count'] += 1
+            h['sum'] += secs
+            h['max'] = max(h['max'], secs)
+            for i, bound in enumerate(BUCKETS):
+                if secs <= bound:
+                    h['buckets'][i] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter()-start, **labels)
+
+    def http_hook(self, r, *args, **kwargs):
+        # requests response hook, counting responses by host and status, and timing them
+        host = urlsplit(r.url).netloc
+        self.inc('http_responses_total', host=host, status=r.status_code)
+        self.observe('http_response_seconds', r.elapsed.total_seconds(), host=host)
+
+    def instrument(self, session):
+        session.hooks['response'].append(self.http_hook)
+        return session
+
+    def flush(self, jsonfile=None, promfile=None, **extra):
+        # emit and reset the observations since the last flush
+        with self._lock:
+            counters, gauges, histograms = self.counters, self.gauges, self.histograms
+            self.counters, self.gauges, self.histograms = {}, {}, {}
+            total_counters, total_gauges, total_histograms = self.totals
+            for key, value in counters.items():
+                total_counters[key] = total_counters.get(key, 0)+value
+            total_gauges.update(gauges)
+            for key, h in histograms.items():
+                total = total_histograms.setdefault(key, dict(count=0, sum=0., max=0., buckets=[0]*len(BUCKETS)))
+                total['count'] += h['count']
+                total['sum'] += h['sum']
+                total['max'] = max(total['max'], h['max'])
+                total['buckets'] = [a+b for a, b in zip(total['buckets'], h['buckets'])]
+            totals = dict(total_counters), dict(total_gauges), {k: dict(h) for k, h in total_histograms.items()}
+
+        if jsonfile:
+            line = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S%z'), **extra,
+                        counters={_name(k): v for k, v in sorted(counters.items())},
+                        gauges={_name(k): _json(v) for k, v in sorted(gauges.items())},
+                        timings={_name(k): dict(count=h['count'], sum=round(h['sum'], 6), max=round(h['max'], 6))
+                                 for k, h in sorted(histograms.items())})
+            with open(jsonfile, 'a') as f:
+                f.write(json.dumps(line)+'\n')
+        if promfile:
+            self._write_prometheus(promfile, *totals)
+
+    def _write_prometheus(self, fname, counters, gauges, histograms, prefix='rustalert_'):
+        lines, seen = [], set()
+        def typed(key, kind):
+            if (key[0], kind) not in seen:
+                seen.add((key[0], kind))
+                lines.append(f'# TYPE {prefix}{key[0]} {kind}')
+        for key, value in sorted(counters.items()):
+            typed(key, 'counter')
+            lines.append(f'{prefix}{_name(key)} {value}')
+        for key, value in sorted(gauges.items()):
+            typed(key, 'gauge')
+            lines.append(f'{prefix}{_name(key)} {_prom(value)}')
+        for (name, labels), h in sorted(histograms.items()):
+            typed((name, labels), 'histogram')
+            for bound, count in zip(BUCKETS+('+Inf',), h['buckets']+[h['count']]):
+                lines.append(f'{prefix}{_name((name+"_bucket", labels+(("le", str(bound)),)))} {count}')
+            lines.append(f'{prefix}{_name((name+"_sum", labels))} {h["sum"]}')
+            lines.append(f'{prefix}{_name((name+"_count", labels))} {h["count"]}')
+        # write-then-rename, so a scrape never sees a partial file
+        with atomic_open(fname) as f:
+            f.write('\n'.join(lines)+'\n')
+
+
+# one registry per process, shared by every module
+METRICS = Metrics()
@@ -1,9 +1,44 @@
 import datetime as dt
-import pytz
-import matplotlib.pyplot as plt
-import pandas as pd
+import threading
 
-def plot4email(df_counts, df_pump=None, threshold=None, ago_limit=None, title=None, output='plot4email.png'):
+from lazy import LazyModule
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+pytz = LazyModule('pytz')
+
+# matplotlib is only imported once a plot is actually made.
+# Figures are drawn straight to Agg and kept as templates, one per size and resolution
+_templates = {}
+_lock = threading.Lock()
+
+
+def _template(figsize, dpi):
+    key = (tuple(figsize), dpi)
+    if key not in _templates:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.collections import PolyCollection
+        from matplotlib.transforms import blended_transform_factory
+
+        fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        line, = ax.plot([], [])
+        threshold_line = ax.axhline(0, color='black', linewidth=1, visible=False)
+        # pump off-on cycles as one collection spanning the full height of the axes
+        spans = PolyCollection([], alpha=0.25, color='orange',
+                               transform=blended_transform_factory(ax.transData, ax.transAxes))
+        ax.add_collection(spans)
+        ax.set_ylabel("Cells per Liter")
+        ax.xaxis_date()
+        ax.tick_params(axis='x', labelrotation=40)
+        _templates[key] = fig, ax, line, threshold_line, spans
+    return _templates[key]
+
+
+def plot4email(df_counts, df_pump=None, threshold=None, ago_limit=None, title=None, output='plot4email.png',
+               figsize=(10, 4), dpi=100):
 
     if ago_limit:
         start = dt.datetime.now(pytz.UTC) - dt.timedelta(days=ago_limit)
@@ -15,29 +50,60 @@ def plot4email(df_counts, df_pump=None, threshold=None, ago_limit=None, title=No
             mask_pump = df_pump['pump_turned_off'] > start
             df_pump = df_pump[mask_pump]
 
-    fig, ax = plt.subplots(figsize=(10, 4))
+    if not output:
+        return _plot4show(df_counts, df_pump, threshold, title, figsize)
 
-    # plot cells per liter timeseries
-    ax.plot(df_counts['sample_time'], df_counts['taxon_perL'])
+    from matplotlib.dates import date2num
+    with _lock:
+        fig, ax, line, threshold_line, spans = _template(figsize, dpi)
+
+        # plot cells per liter timeseries
+        x = date2num(pd.DatetimeIndex(df_counts['sample_time']).to_pydatetime())
+        line.set_data(x, df_counts['taxon_perL'].to_numpy())
+        now = date2num(dt.datetime.now(pytz.UTC))
+        xlim = [x.min(), x.max()] if len(x) else [now-1, now]
 
-    if df_pump is not None:
         # plot a vertical span for each pump off-on cycle
-        for idx, row in df_pump.iterrows():
-            pump_on = row['pump_back_on'] if not pd.isna(row['pump_back_on']) else dt.datetime.now(pytz.UTC)
-            ax.axvspan(xmin=row['pump_turned_off'], xmax=pump_on,
-                       alpha=0.25, color='orange')
+        verts = []
+        if df_pump is not None and not df_pump.empty:
+            pump_on = df_pump['pump_back_on'].fillna(pd.Timestamp.now(tz='UTC'))
+            x0 = date2num(pd.DatetimeIndex(df_pump['pump_turned_off']).to_pydatetime())
+            x1 = date2num(pd.DatetimeIndex(pump_on).to_pydatetime())
+            verts = np.stack([np.column_stack([x0, x0, x1, x1]),
+                              np.tile([0, 1, 1, 0], (len(x0), 1))], axis=-1)
+            xlim = [min(xlim[0], x0.min()), max(xlim[1], x1.max())]
+        spans.set_verts(verts)
 
-    if threshold:
         # plot horizontal threshold line
-        ax.hlines(y=threshold, xmin=df_counts.sample_time[0], xmax=df_counts.sample_time[-1], color='black', linewidth=1)
+        threshold_line.set_visible(bool(threshold))
+        if threshold:
+            threshold_line.set_ydata([threshold, threshold])
 
-    # annotations
-    if title: ax.set_title(title)
-    ax.set_ylabel("Cells per Liter")
-    plt.xticks(rotation=40, ha='right')
+        # annotations
+        ax.set_title(title or '')
+        if xlim[0] == xlim[1]:
+            xlim = [xlim[0]-0.5, xlim[1]+0.5]
+        ax.set_xlim(*xlim)
+        ax.relim(visible_only=True)  # leaves out a hidden threshold line
+        ax.autoscale_view(scalex=False)
+        for label in ax.get_xticklabels():
+            label.set_horizontalalignment('right')
 
-    if output:
         fig.savefig(output, bbox_inches='tight')
-    else:
-        fig.show()
 
+
+def _plot4show(df_counts, df_pump, threshold, title, figsize):
+    # interactive display, through pyplot and its default backend
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=figsize)
+    ax.plot(df_counts['sample_time'], df_counts['taxon_perL'])
+    if df_pump is not None:
+        for idx, row in df_pump.iterrows():
+            pump_on = row['pump_back_on'] if not pd.isna(row['pump_back_on']) else dt.datetime.now(pytz.UTC)
+            ax.axvspan(xmin=row['pump_turned_off'], xmax=pump_on, alpha=0.25, color='orange')
+    if threshold:
+        ax.axhline(y=threshold, color='black', linewidth=1)
+    if title: ax.set_title(title)
+    ax.set_ylabel("Cells per Liter")
+    plt.xticks(rotation=40, ha='right')
+    fig.show()
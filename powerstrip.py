@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, monotonic
+
+from lazy import LazyModule
+from metrics import METRICS
+
+requests = LazyModule('requests')
+
+
+class OutletError(Exception):
+    pass
+
+
+class Powerstrip:
+    # REST client for the network power switch's relay outlets, keeping one
+    # authenticated session. Every command is confirmed by polling physical_state
+
+    def __init__(self, url_prefix, credentials=None, timeout=7, confirm_timeout=5, retries=2, verbose=0):
+        self.url_prefix = url_prefix
+        self.timeout = timeout
+        self.confirm_timeout = confirm_timeout
+        self.retries = retries
+        self.verbose = verbose
+        self.session = METRICS.instrument(requests.Session())
+        self.session.auth = credentials
+        self.session.headers['X-CSRF'] = 'asdf'
+
+    def get(self, outlet):
+        url = f'{self.url_prefix}/restapi/relay/outlets/{outlet}/physical_state/'
+        r = self.session.get(url, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def set(self, outlet, state):
+        url = f'{self.url_prefix}/restapi/relay/outlets/{outlet}/state/'
+        r = self.session.put(url, data={'value': 'true' if state else 'false'}, timeout=self.timeout)
+        r.raise_for_status()
+
+    def confirm(self, outlet, state):
+        # poll physical_state with a short backoff until it reads `state`, or give up
+        deadline = monotonic()+self.confirm_timeout
+        delay = 0.05
+        while True:
+            METRICS.inc('outlet_polls_total', outlet=outlet+1)
+            if self.get(outlet) is state:
+                return True
+            if monotonic()+delay > deadline:
+                return False
+            sleep(delay)
+            delay = min(2*delay, 1)
+
+    def switch(self, outlet, state):
+        # set and confirm one outlet, retrying on failure
+        start = monotonic()
+        for attempt in range(1+self.retries):
+            try:
+                self.set(outlet, state)
+                if self.confirm(outlet, state):
+                    METRICS.inc('outlet_attempts_total', outlet=outlet+1, result='ok')
+                    METRICS.observe('outlet_switch_seconds', monotonic()-start, outlet=outlet+1)
+                    if self.verbose: print(f'  Outlet {outlet+1} {"ON" if state else "OFF"} confirmed in {1000*(monotonic()-start):.0f} ms\n', end='')
+                    return
+                error = 'state not confirmed'
+            except (requests.exceptions.RequestException, ValueError) as e:
+                error = type(e).__name__
+            METRICS.inc('outlet_attempts_total', outlet=outlet+1, result=error.replace(' ', '_'))
+        raise OutletError(f'Outlet {outlet+1} not switched {"ON" if state else "OFF"} after {1+self.retries} attempts ({error})')
+
+    def switch_all(self, states, rollback=None):
+        # switch several outlets at once, states being {outlet: state}. If any fail and
+        # a rollback {outlet: state} is given, the outlets are returned to it before raising
+        with ThreadPoolExecutor(max_workers=len(states)) as pool:
+            futures = [pool.submit(self.switch, outlet, state) for outlet, state in states.items()]
+            errors = [f.exception() for f in futures if f.exception()]
+        if errors:
+            if rollback:
+                for outlet, state in rollback.items():
+                    try:
+                        self.switch(outlet, state)
+                    except OutletError as e:
+                        errors.append(e)
+            raise OutletError('; '.join(map(str, errors)))
+
+
+_powerstrips = {}
+
+def get_powerstrip(url_prefix, credentials=None, **kwargs):
+    # one Powerstrip, and so one session, per switch
+    key = (url_prefix, credentials)
+    if key not in _powerstrips:
+        _powerstrips[key] = Powerstrip(url_prefix, credentials, **kwargs)
+    return _powerstrips[key]
@@ -0,0 +1,40 @@
+import threading
+from time import sleep, monotonic
+
+import requests
+
+
+class RateLimiter:
+    # token bucket allowing `rate` requests per second on average, in bursts of up to `burst`
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.last = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # block until a request may go out
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens+(now-self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1-self.tokens)/self.rate
+            sleep(wait)
+
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    # connection pool whose requests all wait on one RateLimiter
+
+    def __init__(self, limiter, **kwargs):
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire()
+        return super().send(request, **kwargs)
@@ -1,21 +1,61 @@
 import argparse
 import datetime as dt
+import hashlib
+import io
+import json
+import math
 import os.path
-from time import sleep
-from smtplib import SMTP_SSL as SMTP
-from urllib.error import HTTPError
-from email.mime.text import MIMEText
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import shlex
+import threading
+from urllib.parse import urlsplit, urlencode
+from urllib.request import urlopen
+
+from lazy import LazyModule
+from storage import open_store, check_store
+from cache import BinCache, Unclassified
+from powerstrip import get_powerstrip, OutletError
+from triggers import MODES, history_needed, trigger_signal, perL_series
+from metrics import METRICS
+import statefiles
+from statefiles import atomic_open, StateLock, Busy, remove_stale_tmp, quarantine
+
+# imported on first use, see idle_run(). Emailing, plotting and the status endpoint are imported where used
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+requests = LazyModule('requests')
+pytz = LazyModule('pytz')
+
+
+def get_session(pool_size=8, rate_limit=None):
+    # one keep-alive connection pool shared by every dashboard request,
+    # optionally limited to rate_limit requests per second
+    session = requests.Session()
+    if rate_limit:
+        from ratelimit import RateLimiter, RateLimitedAdapter
+        adapter = RateLimitedAdapter(RateLimiter(rate_limit), pool_connections=pool_size, pool_maxsize=pool_size)
+    else:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return METRICS.instrument(session)
+
 
-import pandas as pd
-import requests
-import pytz
+_sessions = {}
+_sessions_lock = threading.Lock()
 
-from emailing import send_emails
-from plotting import plot4email
+def get_host_session(url, pool_size=8, rate_limit=None):
+    # one session, and so one connection pool and rate limit, per dashboard host.
+    # The first caller's pool size and rate limit are kept
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        if host not in _sessions:
+            _sessions[host] = get_session(pool_size, rate_limit)
+        return _sessions[host]
 
 
-def list_bins(url_prefix, dataset, instrument, start_date, end_date=None):
+def list_bins(url_prefix, dataset, instrument, start_date, end_date=None, session=requests, timeout=None):
     url = f'{url_prefix}/api/list_bins'
 
     if isinstance(start_date,dt.datetime):
@@ -30,7 +70,8 @@ def list_bins(url_prefix, dataset, instrument, start_date, end_date=None):
     if end_date:
         params['end_date'] = end_date
 
-    r = requests.get(url, params=params)
+    r = session.get(url, params=params, timeout=timeout)
+    r.raise_for_status()
     df = pd.DataFrame(r.json()['data'])
     if df.empty: return df
 
@@ -40,46 +81,72 @@ def list_bins(url_prefix, dataset, instrument, start_date, end_date=None):
     return df
 
 
-def get_bin_meta(url_prefix, bin_id):
+def get_bin_meta(url_prefix, bin_id, session=requests, timeout=None):
     url = f'{url_prefix}/api/bin/{bin_id}'
-    r = requests.get(url, params={'include_coordinates': 'false'})
+    r = session.get(url, params={'include_coordinates': 'false'}, timeout=timeout)
+    r.raise_for_status()
     return r.json()
 
 
-def get_class_scores(url_prefix, dataset, bin_id):
+def get_bin_ml(url_prefix, bin_id, session=requests, timeout=None):
+    # a bin's ml_analyzed. Raises Unclassified if the dashboard has no such bin, or no ml_analyzed for it
+    try:
+        d = get_bin_meta(url_prefix, bin_id, session=session, timeout=timeout)
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            raise Unclassified(f'no bin {bin_id}') from e
+        raise
+    if not d.get('ml_analyzed'):
+        raise Unclassified(f'no ml_analyzed for {bin_id}')
+    return float(d['ml_analyzed'].rstrip(' ml'))
+
+
+def get_class_counts(url_prefix, dataset, bin_id, session=requests, timeout=None, chunksize=4096):
+    # number of rois per class, counting each roi as its highest scoring class. Rois without any scores aren't counted.
+    # Scores are streamed in float32 chunks, so the full score table is never held in memory.
+    # Raises Unclassified if the bin has no class scores (yet)
     url = f'{url_prefix}/{dataset}/{bin_id}_class_scores.csv'
-    return pd.read_csv(url, index_col='pid')
-
-
-def get_outlet(url_prefix, credentials, outlet):
-    url = f'{url_prefix}/restapi/relay/outlets/{outlet}/physical_state/'
-    r = requests.get(url, auth=credentials, timeout=7)
-    return r.json()
-
-
-def set_outlet(url_prefix, credentials, outlet, state):
-    url = f'{url_prefix}/restapi/relay/outlets/{outlet}/state/'
-    requests.put(url, auth=credentials,
-        data={'value': 'true' if state else 'false'},
-        headers={'X-CSRF': 'asdf'} )
-
-
-def set_pumpOff_aeratorOn(pump_args,aerator_args):
-    set_outlet(*pump_args,False)
-    sleep(1)
-    assert get_outlet(*pump_args) is False
-    set_outlet(*aerator_args,True)
-    sleep(1)
-    assert get_outlet(*aerator_args) is True
-
+    with session.get(url, timeout=timeout, stream=True) as r:
+        if r.status_code == 404:
+            raise Unclassified(f'no class scores for {bin_id}')
+        r.raise_for_status()
+        r.raw.decode_content = True
+        reader = pd.read_csv(r.raw, usecols=lambda col: col!='pid', dtype=np.float32, chunksize=chunksize)
+        counts = None
+        for chunk in reader:
+            scores = chunk.to_numpy()
+            unscored = np.isnan(scores).all(axis=1)
+            if unscored.any():
+                scores = scores[~unscored]
+            scores = np.nan_to_num(scores, nan=-np.inf, copy=False)
+            if counts is None:
+                classes = chunk.columns
+                counts = np.zeros(len(classes), dtype=int)
+            counts += np.bincount(scores.argmax(axis=1), minlength=len(classes))
+    if counts is None:
+        return pd.Series(dtype=int)
+    return pd.Series(counts, index=classes)
+
+
+def fetch_bins(func, bin_ids, workers=8, errors=Exception, verbose=0, fmt=str, metric=None, labels=None):
+    # run func(bin_id) for every bin, at most `workers` at a time.
+    # bins raising one of `errors` are reported and left out of the results.
+    # With a metric name, outcomes are counted by result ("ok" or the exception name)
+    results = {}
+    labels = labels or {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(func, bin_id): bin_id for bin_id in bin_ids}
+        for future in as_completed(futures):
+            bin_id = futures[future]
+            try:
+                results[bin_id] = future.result()
+                if metric: METRICS.inc(metric, result='ok', **labels)
+                if verbose: print(f'  {bin_id}: {fmt(results[bin_id])}')
+            except errors as e:
+                if metric: METRICS.inc(metric, result=type(e).__name__, **labels)
+                if verbose: print(f'  {bin_id}: NaN ({e})')
+    return results
 
-def set_pumpOn_aeratorOff(pump_args,aerator_args):
-    set_outlet(*pump_args,True)
-    sleep(1)
-    assert get_outlet(*pump_args) is True
-    set_outlet(*aerator_args,False)
-    sleep(1)
-    assert get_outlet(*aerator_args) is False
 
 def get_pump_timer(fname):
     if os.path.isfile(fname) and os.path.getsize(fname) > 0:
@@ -94,208 +161,333 @@ def set_pump_timer(fname,timestamp):
         timestamp = timestamp.isoformat()
     elif isinstance(timestamp,dt.datetime):
         timestamp = timestamp.isoformat(timespec='seconds')
-    with open(fname, 'w') as f:
+    with atomic_open(fname) as f:
         f.write(timestamp)
 
-
-def update_datafile(args):
-    # 1) collect new bin list
+# the poll cursor, latest sample_time already ingested, is stored just like the pump timer
+get_poll_cursor = get_pump_timer
+set_poll_cursor = set_pump_timer
+
+
+def list_new_bins(args, since, now, session=requests):
+    # list bins from `since` until now, paging through long gaps args.poll_chunk hours at a time
+    chunks = []
+    start = since
+    while True:
+        end = min(start+dt.timedelta(hours=args.poll_chunk), now)
+        if args.v>=2: print(f'Fetching Bins since {start.isoformat(timespec="seconds")} from {args.dashboard.replace("https://","")} {args.dataset} {args.ifcb}')
+        chunk = list_bins(args.dashboard, args.dataset, args.ifcb, start_date=start,
+                          end_date=end if end<now else None, session=session, timeout=args.http_timeout)
+        if not chunk.empty:
+            chunks.append(chunk)
+        if end >= now:
+            break
+        start = end
+    if not chunks:
+        return pd.DataFrame()
+    bin_df = pd.concat(chunks)
+    return bin_df[~bin_df.index.duplicated()]
+
+
+def pump_step(taxon_perL, sample_time, pump_timer, threshold, timer, threshold_off=None):
+    # the pump timer state machine, free of any I/O. Shared by check_datafile and backtest.py
+    # Returns the event and the new pump timer (sample_time of the latest bin above threshold)
+    # With a threshold_off, bins above it keep re-setting the timer once the pump is off (hysteresis)
+    if pump_timer is not None and threshold_off is not None:
+        threshold = min(threshold, threshold_off)
+    if taxon_perL > threshold:
+        if pump_timer is None:
+            return 'pump_off', sample_time
+        elif pump_timer == sample_time:
+            return 'still_above', sample_time  # no new classification data
+        return 'timer_reset', sample_time
+    elif pump_timer is not None and sample_time - pump_timer > dt.timedelta(hours=timer):
+        return 'pump_on', None
+    elif pump_timer is not None:
+        return 'timer_running', pump_timer
+    return 'all_well', None
+
+
+def update_datafile(args, session=None, store=None, shared=None, cache=None, state=None):
+    # shared, if given, memoizes bin downloads across several rules' updates.
+    # cache, if given, is a BinCache persisting them across runs.
+    # state, if given, gets the saved poll cursor and when the next pending bin is due, see save_idle()
+    if session is None:
+        session = get_session(args.workers)
+    if store is None:
+        store = open_store(args.datafile)
+    if shared is None:
+        shared = {}
+    shared_ml = shared.setdefault('ml', {})
+    shared_counts = shared.setdefault('counts', {})
+    labels = dict(ifcb=args.ifcb, taxon=args.taxon, site=args.site)
+    stage = lambda name: METRICS.timer('stage_seconds', stage=name, **labels)
+
+    # 1) collect new bin list, starting from the poll cursor
     now = dt.datetime.now(pytz.UTC)
     now = now-dt.timedelta(microseconds=now.microsecond) # dump microseconds
-    poll_date = now-dt.timedelta(hours=3)
-    poll_date = poll_date.isoformat(timespec='hours')
-    if args.v>=2: print(f'Fetching Bins since {poll_date} from {args.dashboard.replace("https://","")} {args.dataset} {args.ifcb}')
-    bin_df = list_bins(args.dashboard, args.dataset, args.ifcb, start_date=poll_date)
+    if store.exists():
+        cursor = get_poll_cursor(args.cursorfile)
+    else:
+        if args.v: print(f'  {args.datafile} not found: one will be created')
+        cursor = None
+    if cursor is None:
+        cursor = now-dt.timedelta(hours=3)
+        cursor = cursor.replace(minute=0, second=0)
+    else:
+        cursor = max(cursor.to_pydatetime(), now-dt.timedelta(days=args.buffer))
+    METRICS.set('poll_lag_seconds', (now-cursor).total_seconds(), **labels)
+    with stage('list_bins'):
+        bin_df = list_new_bins(args, cursor, now, session=session)
+    METRICS.inc('bins_listed_total', len(bin_df), **labels)
     if args.v>=3: print('  '+'\n  '.join(list(bin_df.index)))
     if args.v>2: print(f'  {len(bin_df)} bins fetched')
 
-    # 2) load datafile, append new bins to df, else create new df
-    if args.v>=2: print(f'Loading Datafile: {args.datafile}')
-    try:
-        df = pd.read_csv(args.datafile, index_col='pid', parse_dates=['sample_time'])
-        df = df.combine_first(bin_df)
-    except FileNotFoundError:
-        if args.v: print('  FileNotFound: one will be created')
-        df = bin_df
-        df['bin_ml'] = float('nan')
-        df['bin_added'] = float('nan')
-        df['taxon_count'] = float('nan')
-        df['taxon_perL'] = float('nan')
-        df['taxon_added'] = float('nan')
+    # 2) add new bins to the datafile, then pick out bins still missing values
+    if args.v>=2: print(f'Updating Datafile: {args.datafile}')
+    cutoff = now-dt.timedelta(days=args.buffer)
+    with stage('add_bins'):
+        store.add_bins(bin_df)
+        df = store.pending(since=cutoff)
+    METRICS.set('bins_pending', len(df), **labels)
+
+    # bins to fetch, newest first so the latest reading is never stuck behind a backlog.
+    # Bins whose last fetch failed are left out while backing off, or for good once given up on,
+    # and at most args.fetch_limit bins are fetched per run, the rest wait for the next
+    def queue(column, kind):
+        missing = df[df[column].isna()].sort_values('sample_time', ascending=False).index
+        if cache:
+            missing = [bin_id for bin_id in missing if not cache.waiting(kind, bin_id)]
+        waiting = int(df[column].isna().sum())-len(missing)
+        METRICS.set('bins_waiting', waiting, kind=column, **labels)
+        if args.v and waiting: print(f'  {waiting} bins waiting to retry')
+        return list(missing[:args.fetch_limit] if args.fetch_limit else missing)
 
     # 3) collect new ml for any new bins
     if args.v: print('Collecting bin_ml values')
-    def do_bin_ml(row):
-        if pd.isna(row['bin_ml']):
-            if args.v: print(f'  {row.name}: ', end='')
-            try:
-                d = get_bin_meta(args.dashboard, row.name)
-                row['bin_ml'] = float(d['ml_analyzed'].rstrip(' ml'))
-                row['bin_added'] = now
-                if args.v: print(row['bin_ml'],'ml')
-            except Exception as e:
-                if args.v: print(f'NaN ({e})')
-        return row
-    df = df.apply(do_bin_ml, axis='columns')
+    def bin_ml(bin_id):
+        if bin_id not in shared_ml:
+            def fetch():
+                with METRICS.timer('bin_fetch_seconds', kind='ml'):
+                    return get_bin_ml(args.dashboard, bin_id, session=session, timeout=args.http_timeout)
+            shared_ml[bin_id] = cache.fetch('meta', bin_id, fetch) if cache else fetch()
+        return shared_ml[bin_id]
+    missing = queue('bin_ml', 'meta')
+    with stage('fetch_ml'):
+        ml = fetch_bins(bin_ml, missing, args.workers, verbose=args.v, fmt=lambda ml: f'{ml} ml',
+                        metric='bins_fetched_total', labels=dict(kind='ml', **labels))
+    if ml:
+        ml = pd.Series(ml)
+        df.loc[ml.index, 'bin_ml'] = ml
+        df.loc[ml.index, 'bin_added'] = now
 
     # 4) collect class scores for any missing
     if args.v: print('Collecting class scores and calculating counts')
-    def taxon_per_liter(row):
-        if pd.isna(row['taxon_count']):
-            if args.v: print(f'  {row.name}: ', end='')
-            try:
-                score_df = get_class_scores(args.dashboard, args.dataset, row.name)
-                counts_series = score_df.idxmax(axis='columns').value_counts()
-                row['taxon_count'] = counts_series[args.taxon] if args.taxon in counts_series else 0
-                row['taxon_perL'] = 1000*row['taxon_count']/row['bin_ml']
-                row['taxon_added'] = now
-                if args.v: print(f"{row['taxon_count']} ({round(row['taxon_perL'])} perL)")
-            except HTTPError as e:
-                if args.v: print(f'NaN ({e})')
-        return row
-    df = df.apply(taxon_per_liter, axis='columns')
-
-    # 5) limit size of saved df
-    df = df[df['sample_time']>now-dt.timedelta(days=args.buffer)]
+    def taxon_count(bin_id):
+        key = (args.dataset, bin_id)
+        if key not in shared_counts:
+            def fetch():
+                with METRICS.timer('bin_fetch_seconds', kind='counts'):
+                    counts_series = get_class_counts(args.dashboard, args.dataset, bin_id,
+                                                     session=session, timeout=args.http_timeout)
+                return {taxon: int(count) for taxon, count in counts_series.items()}
+            shared_counts[key] = cache.fetch(f'counts/{args.dataset}', bin_id, fetch) if cache else fetch()
+        return shared_counts[key].get(args.taxon, 0)
+    missing = queue('taxon_count', f'counts/{args.dataset}')
+    with stage('fetch_counts'):
+        counts = fetch_bins(taxon_count, missing, args.workers, verbose=args.v,
+                            metric='bins_fetched_total', labels=dict(kind='counts', **labels))
+    if counts:
+        counts = pd.Series(counts, dtype=float)
+        df.loc[counts.index, 'taxon_count'] = counts
+        df.loc[counts.index, 'taxon_added'] = now
+    # perL once a bin has both, which may be runs apart
+    ready = df['taxon_perL'].isna() & df['bin_ml'].notna() & df['taxon_count'].notna()
+    df.loc[ready, 'taxon_perL'] = 1000*df.loc[ready, 'taxon_count']/df.loc[ready, 'bin_ml']
+    METRICS.set('bins_unclassified', int(df['taxon_count'].isna().sum()), **labels)
+    if state is not None:
+        # failures only cached in memory are forgotten by the next run, so count as due at once
+        due = [cache.due_at(kind, bin_id) if cache and cache.root else 0
+               for column, kind in [('bin_ml', 'meta'), ('taxon_count', f'counts/{args.dataset}')]
+               for bin_id in df.index[df[column].isna()]]
+        state['due'] = min([t for t in due if not math.isinf(t)], default=None)
+
+    # 5) write back fetched values, limit size of saved data
+    with stage('update_store'):
+        store.update(df)
+        store.prune(cutoff)
 
     # 6) save datafile
     if args.v>=2: print(f'Saving file: {args.datafile}')
-    df.to_csv(args.datafile)
-    return df
+    with stage('save_store'):
+        store.save()
+
+    # 7) advance the poll cursor, only once the new bins are safely saved
+    if not bin_df.empty:
+        set_poll_cursor(args.cursorfile, max(bin_df['sample_time'].max(), cursor))
+    if state is not None:
+        state['cursor'] = get_poll_cursor(args.cursorfile)
+    return store
 
 
-def check_datafile(args, df_bins=None):
+def check_datafile(args, store=None, state=None):
+    # state, if given, holds the pump log and pump timer in memory between calls
+    if state is None:
+        state = {}
     now = dt.datetime.now(pytz.UTC)
     now = now-dt.timedelta(microseconds=now.microsecond) # dump microseconds
+    labels = dict(ifcb=args.ifcb, taxon=args.taxon, site=args.site)
+    stage = lambda name: METRICS.timer('stage_seconds', stage=name, **labels)
 
     # 1) load files
     # Datafile
-    if df_bins is None:
+    if store is None:
         if args.v>=2: print(f'Reading Datafile: {args.datafile}')
-        df_bins = pd.read_csv(args.datafile, index_col='pid', parse_dates=['sample_time'])
-    latest_valid_row = df_bins[~df_bins['taxon_perL'].isna()].iloc[-1]
+        store = open_store(args.datafile)
+    with stage('read_history'):
+        history = store.tail_valid(history_needed(args.trigger, args.window))
+    if history.empty:
+        if args.v: print('No classified bins yet')
+        state['settled'] = True
+        return
+    latest_valid_row = history.iloc[-1]
     bin_id = latest_valid_row.name
     taxon_perL = latest_valid_row['taxon_perL']
     sample_time = latest_valid_row['sample_time']
+    signal = trigger_signal(perL_series(history), args.trigger, args.window).iloc[-1]
+    METRICS.set('taxon_perL', taxon_perL, **labels)
+    METRICS.set('trigger_signal', signal, **labels)
+    METRICS.set('sample_age_seconds', (now-sample_time).total_seconds(), **labels)
 
     # Logfile
-    try:
-        if args.v>=2: print(f'Reading Logfile: {args.logfile}')
-        df_log = pd.read_csv(args.logfile, index_col='triggering_bin')
-        df_log['pump_turned_off'] = pd.to_datetime(df_log['pump_turned_off'], errors='coerce')
-        df_log['pump_back_on'] = pd.to_datetime(df_log['pump_back_on'], errors='coerce')
-    except FileNotFoundError:
-        if args.v>=2: print('  FileNotFound: one may be created')
-        cols = dict(triggering_bin=[], pump_turned_off=[], pump_back_on=[])
-        df_log = pd.DataFrame(cols).set_index('triggering_bin')
+    if 'log' in state:
+        df_log = state['log']
+    else:
+        try:
+            if args.v>=2: print(f'Reading Logfile: {args.logfile}')
+            with stage('read_log'):
+                df_log = pd.read_csv(args.logfile, index_col='triggering_bin')
+                df_log['pump_turned_off'] = pd.to_datetime(df_log['pump_turned_off'], errors='coerce')
+                df_log['pump_back_on'] = pd.to_datetime(df_log['pump_back_on'], errors='coerce')
+        except FileNotFoundError:
+            if args.v>=2: print('  FileNotFound: one may be created')
+            cols = dict(triggering_bin=[], pump_turned_off=[], pump_back_on=[])
+            df_log = pd.DataFrame(cols).set_index('triggering_bin')
+        state['log'] = df_log
 
     # Pump Timer
-    if args.v>=2: print(f'Reading Timerfile: {args.timerfile}')
-    pump_timer = get_pump_timer(args.timerfile)
-    if args.v>=2: print(f'  Pump timer: {str(now-pump_timer).split(".")[0] if pump_timer else None}')
-
-    # 2) get pump and aerator state
-    if args.powerstrip:
-        if args.v: print('Checking Powerstrip States')
-        pump_args = [args.powerstrip,args.powerstrip_auth,args.pump_outlet]
-        aerator_args = [args.powerstrip,args.powerstrip_auth,args.aerator_outlet]
-        try:
-            pump_state = 'ON' if get_outlet(*pump_args) else 'OFF'
-            aerator_state = 'ON' if get_outlet(*aerator_args) else 'OFF'
-        except requests.exceptions.RequestException as e:
-            print(f'  ERROR: get_outlet({args.powerstrip}) - Connection Failed')
-            pump_state,aerator_state = '???','???'
-        if args.v: print(f'  Pump Outlet:    {pump_state}\n  Aerator Outlet: {aerator_state}')
+    if 'timer' in state:
+        pump_timer = state['timer']
     else:
-        pump_state, aerator_state = 'N/A', 'N/A'
+        if args.v>=2: print(f'Reading Timerfile: {args.timerfile}')
+        pump_timer = state['timer'] = get_pump_timer(args.timerfile)
+    if args.v>=2: print(f'  Pump timer: {str(now-pump_timer).split(".")[0] if pump_timer else None}')
 
-    if args.email_config:
-        email_args = dict(TO=args.emails, SMTPserver=args.email_config[0], USER=args.email_config[1], PASS=args.email_config[2])
+    # Outlet switch that failed on an earlier run, awaiting a retry
+    if 'outlet_retry' not in state:
+        state['outlet_retry'] = get_outlet_retry(outlet_retry_file(args)) if args.powerstrip else None
 
-    # 3) check for any triggering behaviors
+    # 2) decide what to do about the latest reading
     ago = now - sample_time
     if args.v:
         print(f'Checking Counts Against Threshold ({args.threshold} perL)')
         print(f'  Latest Counts: {round(taxon_perL)} perL (sample_time: {str(ago).replace("0 days ","")} ago, from {bin_id})')
-
-    if taxon_perL > args.threshold:
-        set_pump_timer(args.timerfile, sample_time)
-        if pump_timer is None:
-
-            msg = ('Counts Above Threshold\n    '
-                   f'Threshold: {args.threshold}/L\n    '
-                   f'Counts: {round(taxon_perL)}/L\n    '
-                   f'SampleTime: {sample_time.astimezone(pytz.timezone("US/Eastern"))}\n    '
-                   f'Bin: {bin_id}\n\n'
-                   )
-
-            if args.powerstrip:
-                try:
-                    set_pumpOff_aeratorOn(pump_args,aerator_args)
-                    pump_state,aerator_state = 'OFF','ON'
-                except requests.exceptions.RequestException as e:
-                    print(f'  ERROR: set_pumpOff_aeratorOn({args.powerstrip}) - Connection Failed')
-                    pump_state,aerator_state = '???','???'
-                msg += ('Setting pump timer + Turning Pump OFF and Aerator ON\n    '
-                        f'Pump (Outlet {args.pump_outlet+1}):    {pump_state}\n    '
-                        f'Aerator (Outlet {args.aerator_outlet+1}): {aerator_state}')
-
-            if args.v: print(msg.replace('\n','; '))
-
-            # writing to pump logfile
-            if args.v >= 2: print(f'Saving new entry to logfile: {args.logfile}')
-            df_log = df_log.append(pd.Series(name=bin_id, data={'pump_turned_off': now}))
-            df_log.to_csv(args.logfile)
-
-            if args.plotfile:
-                plot4email(df_bins, df_log, args.threshold, title=f'{args.taxon}', ago_limit=1, output=args.plotfile)
-
-            if args.email_config:
-                subject = f"[{args.ifcb}] ALERT: Rust Above Threshold"
-                send_emails(SUBJECT=subject, BODY=msg,
-                            attachements=[args.plotfile] if args.plotfile else [],
-                            **email_args)
-
-        elif pump_timer==sample_time:
-            msg = 'Counts Still Above Threshold: No New Classification Data'
-            if args.v: print(msg)
-        else:
-            msg = 'Counts Still Above Threshold: Re-Setting pump timer'
-            if args.v: print(msg)
-
-    elif pump_timer and sample_time - pump_timer > dt.timedelta(hours=args.timer):
-        set_pump_timer(args.timerfile,None)
-
-        msg = ('Counts Below Threshold and Pump Timer has run out\n\n')
-
+        if args.trigger != 'last':
+            print(f'  Trigger ({args.trigger}, {args.window} bins): {signal:.0f}')
+    event, actions = decide(args, signal, sample_time, pump_timer)
+    METRICS.inc('events_total', event=event, **labels)
+    # rules sharing these outlets that still need the pump off keep it off. Turning it back on is left to the last of them
+    holder, retry = None, state['outlet_retry']
+    if args.powerstrip and (event == 'pump_on' or (retry and not retry['pump_off'])):
+        holder = pump_holder(args)
+    if holder:
+        print(f'  Pump kept off for {holder.taxon} ({holder.ifcb}), which still needs it off')
+        actions = [(action, value) for action, value in actions if action != 'outlets']
+        state['outlet_retry'] = None
+        set_outlet_retry(outlet_retry_file(args), None)
+
+    # 3) carry out the actions. Outlets go first, alert plots and emails go to a background worker.
+    # The timer and log follow the event even if the outlets fail to switch, so each event alerts
+    # once, and only the switch is retried, backing off so a failing powerstrip isn't cycled every run
+    def switch(pump_off):
+        switched, pump_state, aerator_state = switch_outlets(args, pump_off)
+        state['outlets'] = pump_state, aerator_state
+        if not switched:
+            METRICS.inc('outlet_failures_total', **labels)
+        state['outlet_retry'] = outlet_retry(args, state['outlet_retry'], pump_off, switched, now)
+        set_outlet_retry(outlet_retry_file(args), state['outlet_retry'])
+        return pump_state, aerator_state
+
+    pump_state, aerator_state = 'N/A', 'N/A'
+    retry = state['outlet_retry']
+    if retry and args.powerstrip and 'outlets' not in {action for action, value in actions}:
+        if retry['retry_at'] <= now.timestamp():
+            print(f'Retrying outlet switch, failed {retry["attempts"]} times')
+            with stage('outlets'):
+                pump_state, aerator_state = switch(retry['pump_off'])
+        elif args.v:
+            print(f'  Outlet switch failed {retry["attempts"]} times, next retry {retry_time(retry)}')
+    for action, value in actions:
+        if action in ['plot', 'email']:
+            continue  # handed to ALERTS below
+        with stage(action):
+            if action == 'outlets':
+                pump_state, aerator_state = switch(pump_off=value=='pump_off')
+            elif action == 'timer':
+                set_pump_timer(args.timerfile, value)
+                state['timer'] = value
+            elif action == 'log':
+                if args.v>=2: print(f'Saving new entry to logfile: {args.logfile}')
+                if value == 'pump_off':
+                    df_log = df_log.append(pd.Series(name=bin_id, data={'pump_turned_off': now}))
+                else:
+                    df_log.iat[-1,df_log.columns.get_loc('pump_back_on')] = now
+                with atomic_open(args.logfile) as f:
+                    df_log.to_csv(f)
+                state['log'] = df_log
+    METRICS.set('pump_off', int(state['timer'] is not None), **labels)
+    # whether checking the same reading again would do nothing, eg not while an outlet switch awaits a retry
+    state['settled'] = not decide(args, signal, sample_time, state['timer'])[1] and not state['outlet_retry']
+
+    if event == 'pump_off':
+        msg = ('Counts Above Threshold\n    '
+               f'Threshold: {args.threshold}/L\n    '
+               f'Counts: {round(taxon_perL)}/L\n    '
+               + (f'Trigger ({args.trigger}, {args.window} bins): {round(signal)}\n    ' if args.trigger != 'last' else '') +
+               f'SampleTime: {sample_time.astimezone(pytz.timezone("US/Eastern"))}\n    '
+               f'Bin: {bin_id}\n\n'
+               )
         if args.powerstrip:
-            try:
-                set_pumpOn_aeratorOff(pump_args,aerator_args)
-                pump_state, aerator_state = 'ON', 'OFF'
-            except requests.exceptions.RequestException as e:
-                print(f'  ERROR: set_pumpOn_aeratorOff({args.powerstrip}) - Connection Failed')
-                pump_state, aerator_state = '???', '???'
+            msg += ('Setting pump timer + Turning Pump OFF and Aerator ON\n    '
+                    f'Pump (Outlet {args.pump_outlet+1}):    {pump_state}\n    '
+                    f'Aerator (Outlet {args.aerator_outlet+1}): {aerator_state}')
+            if state['outlet_retry']:
+                msg += f'\n\nOutlet switch FAILED, retrying from {retry_time(state["outlet_retry"])}'
+        subject = f"[{args.ifcb}] ALERT: Rust Above Threshold"
+        if args.v: print(msg.replace('\n','; '))
+
+    elif event == 'pump_on':
+        msg = ('Counts Below Threshold and Pump Timer has run out\n\n')
+        if holder:
+            msg += f'Pump kept OFF and Aerator ON, {holder.taxon} ({holder.ifcb}) is still above its threshold'
+        elif args.powerstrip:
             msg += ('Turning Pump back ON and Aerator OFF\n    '
                     f'Pump (Outlet {args.pump_outlet + 1}):    {pump_state}\n    '
                     f'Aerator (Outlet {args.aerator_outlet + 1}): {aerator_state}')
-
+            if state['outlet_retry']:
+                msg += f'\n\nOutlet switch FAILED, retrying from {retry_time(state["outlet_retry"])}'
+        subject = f"[{args.ifcb}] Rust Back Below Threshold"
         if args.v: print(' ',msg.replace('\n',';'))
 
-        # writing to pump logfile
-        if args.v>=2: print(f'Saving new entry to logfile: {args.logfile}')
-        df_log.iat[-1,df_log.columns.get_loc('pump_back_on')] = now
-        df_log.to_csv(args.logfile)
+    elif event == 'still_above':
+        msg = 'Counts Still Above Threshold: No New Classification Data'
+        if args.v: print(msg)
 
-        if args.plotfile:
-            plot4email(df_bins, df_log, args.threshold, title=f'{args.taxon}', ago_limit=1, output=args.plotfile)
-
-        if args.email_config:
-            subject = f"[{args.ifcb}] Rust Back Below Threshold"
-            send_emails(SUBJECT=subject, BODY=msg,
-                        attachements=[args.plotfile] if args.plotfile else [],
-                        **email_args)
+    elif event == 'timer_reset':
+        msg = 'Counts Still Above Threshold: Re-Setting pump timer'
+        if args.v: print(msg)
 
-    elif pump_timer:
+    elif event == 'timer_running':
         if args.v:
             remaining = (now-pump_timer)-dt.timedelta(hours=args.timer)
             msg = f'Counts Below Threshold, but {str(remaining).replace("0 days ","")} remains on Pump Timer'
@@ -305,26 +497,502 @@ def check_datafile(args, df_bins=None):
         msg = "Counts Below Threshold: all is well"
         if args.v: print(' ',msg)
 
+    alert = {action for action, value in actions} & {'plot', 'email'}
+    if alert:
+        # snapshot the data here, the store is not shared with the worker thread
+        with stage('alert_snapshot'):
+            df_bins = store.read(since=now-dt.timedelta(days=1)) if 'plot' in alert else None
+        ALERTS.submit(send_alert, args, subject, msg, df_bins, df_log.copy(), 'plot' in alert, 'email' in alert)
+
+    # 4) report pump and aerator state when nothing was switched
+    if args.powerstrip and args.v and 'outlets' not in {action for action, value in actions}:
+        print('Checking Powerstrip States')
+        strip = get_powerstrip(args.powerstrip, args.powerstrip_auth, timeout=args.powerstrip_timeout, verbose=args.v)
+        try:
+            pump_state = 'ON' if strip.get(args.pump_outlet) else 'OFF'
+            aerator_state = 'ON' if strip.get(args.aerator_outlet) else 'OFF'
+        except requests.exceptions.RequestException as e:
+            print(f'  ERROR: powerstrip {args.powerstrip} - Connection Failed')
+            pump_state,aerator_state = '???','???'
+        print(f'  Pump Outlet:    {pump_state}\n  Aerator Outlet: {aerator_state}')
+        state['outlets'] = pump_state, aerator_state
+
+    # 5) publish to the status endpoint, re-rendering its plot in the background when the data changed
+    if args.daemon and args.status_port:
+        with stage('status'):
+            update_status(args, state, store, now, bin_id, sample_time, taxon_perL, signal, event)
+
+
+def update_status(args, state, store, now, bin_id, sample_time, taxon_perL, signal, event):
+    from statusapi import STATUS
+    # outlet states are the last ones switched to or read, else inferred from the pump timer
+    pump_timer, df_log = state['timer'], state['log']
+    if 'outlets' in state:
+        (pump, aerator), outlets_from = state['outlets'], 'powerstrip'
+    elif args.powerstrip:
+        (pump, aerator), outlets_from = ('OFF', 'ON') if pump_timer is not None else ('ON', 'OFF'), 'timer'
+    else:
+        (pump, aerator), outlets_from = (None, None), None
+    summary = dict(dataset=args.dataset, ifcb=args.ifcb, taxon=args.taxon, threshold=args.threshold,
+                   threshold_off=args.threshold_off, trigger=args.trigger, window=args.window,
+                   bin=bin_id, sample_time=sample_time, taxon_perL=taxon_perL, trigger_signal=signal, event=event,
+                   pump=pump, aerator=aerator, outlets_from=outlets_from,
+                   timer_started=pump_timer, timer_expires=pump_timer+dt.timedelta(hours=args.timer) if pump_timer is not None else None,
+                   pump_log_entries=len(df_log), checked=now)
+    key = f'{args.ifcb}/{args.taxon}'
+    history = store.read(since=now-dt.timedelta(days=1))
+    if STATUS.update(key, summary, history[['sample_time', 'taxon_perL']]):
+        ALERTS.submit(render_status_plot, args, key, history, df_log.copy())
+
+
+def render_status_plot(args, key, df_bins, df_log):
+    from plotting import plot4email
+    from statusapi import STATUS
+    try:
+        png = io.BytesIO()
+        plot4email(df_bins, df_log, args.threshold, title=f'{args.taxon}', ago_limit=1, output=png,
+                   figsize=args.plot_size, dpi=args.plot_dpi)
+        STATUS.set_plot(key, png.getvalue())
+    except Exception as e:
+        print(f'  ERROR: status plot {key} -', type(e), e)
+
+
+def decide(args, signal, sample_time, pump_timer):
+    # the alerting and pump-control decisions for the latest trigger signal, free of any I/O.
+    # Returns the pump_step event and an ordered list of (action, value) for check_datafile
+    event, new_timer = pump_step(signal, sample_time, pump_timer, args.threshold, args.timer, args.threshold_off)
+    actions = []
+    if event in ['pump_off', 'pump_on'] and args.powerstrip:
+        actions.append(('outlets', event))
+    if new_timer != pump_timer:
+        actions.append(('timer', new_timer))
+    if event in ['pump_off', 'pump_on']:
+        actions.append(('log', event))
+        if args.plotfile:
+            actions.append(('plot', event))
+        if args.email_config:
+            actions.append(('email', event))
+    return event, actions
+
 
+def link_peers(rules):
+    # each rule's peers: the other rules switching its pump or aerator outlet on the same powerstrip
+    for rule in rules:
+        outlets = {rule.pump_outlet, rule.aerator_outlet}-{None}
+        rule.peers = [other for other in rules if other is not rule and rule.powerstrip
+                      and other.powerstrip == rule.powerstrip and outlets & {other.pump_outlet, other.aerator_outlet}]
 
-if __name__ == '__main__':
+
+def pump_holder(args):
+    # the first peer still needing the pump off: its pump timer is running, or its pump off switch awaits a retry.
+    # Read from the peers' files, which are current in --daemon mode too
+    for peer in args.peers:
+        retry = get_outlet_retry(outlet_retry_file(peer))
+        if get_pump_timer(peer.timerfile) is not None or (retry and retry['pump_off']):
+            return peer
+    return None
+
+
+def outlet_retry_file(args):
+    return os.path.splitext(args.timerfile)[0]+'.outlets.json'
+
+
+def get_outlet_retry(fname):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def set_outlet_retry(fname, retry):
+    if retry is None:
+        if os.path.exists(fname):
+            os.remove(fname)
+        return
+    with atomic_open(fname) as f:
+        json.dump(retry, f)
+
+
+def outlet_retry(args, retry, pump_off, switched, now):
+    # the outlet switch still to be made after an attempt, None once it worked. Retried after
+    # args.outlet_retry minutes, doubling with each failure up to an hour. A new switch
+    # in the other direction supersedes the old one
+    if switched:
+        return None
+    attempts = retry['attempts']+1 if retry and retry['pump_off'] == pump_off else 1
+    wait = min(60*args.outlet_retry*2**(attempts-1), 3600)
+    return dict(pump_off=pump_off, attempts=attempts, retry_at=now.timestamp()+wait)
+
+
+def retry_time(retry):
+    return dt.datetime.fromtimestamp(retry['retry_at'], dt.timezone.utc).isoformat(timespec='seconds')
+
+
+def switch_outlets(args, pump_off):
+    # turn the pump off and aerator on, or back. Both outlets are switched at once.
+    # If turning the pump back on fails, both are returned to pump off + aerator on
+    # Returns whether it worked and the resulting outlet states
+    strip = get_powerstrip(args.powerstrip, args.powerstrip_auth, timeout=args.powerstrip_timeout, verbose=args.v)
+    outlets = {args.pump_outlet: False, args.aerator_outlet: True}
+    protective = {outlet: state for outlet, state in outlets.items() if outlet is not None}
+    normal = {outlet: not state for outlet, state in protective.items()}
+    try:
+        if pump_off:
+            strip.switch_all(protective)
+            return True, 'OFF', 'ON'
+        strip.switch_all(normal, rollback=protective)
+        return True, 'ON', 'OFF'
+    except OutletError as e:
+        print(f'  ERROR: powerstrip {args.powerstrip} - {e}')
+        return False, '???', '???'
+
+
+# alert plots run here, one at a time, off the monitoring critical path.
+# Emails are then queued to the outbox and sent from there
+ALERTS = ThreadPoolExecutor(max_workers=1)
+
+def send_alert(args, subject, msg, df_bins, df_log, plot, email):
+    from emailing import get_outbox
+    from plotting import plot4email
+    try:
+        if plot:
+            with METRICS.timer('alert_seconds', step='plot'):
+                plot4email(df_bins, df_log, args.threshold, title=f'{args.taxon}', ago_limit=1, output=args.plotfile,
+                           figsize=args.plot_size, dpi=args.plot_dpi)
+        if email:
+            with METRICS.timer('alert_seconds', step='queue_email'):
+                outbox = get_outbox(args.outbox, *args.email_config)
+                outbox.put(TO=args.emails, SUBJECT=subject, BODY=msg,
+                           attachements=[args.plotfile] if plot else [])
+    except Exception as e:
+        METRICS.inc('alert_errors_total', error=type(e).__name__)
+        print(f'  ERROR: alert "{subject}" -', type(e), e)
+
+
+def run_rules(rules, session, states, cache=None):
+    # one update+check pass per rule. Bins are downloaded once and shared between rules
+    shared = {}
+    for rule, state in zip(rules, states):
+        prefix = f'[{rule.site}] ' if rule.site else ''
+        if len(rules)>1 or rule.site: print(f'{prefix}TAXON:', rule.taxon, f'({rule.dataset} {rule.ifcb})')
+        else: print('TAXON:', rule.taxon)
+        labels = dict(ifcb=rule.ifcb, taxon=rule.taxon, site=rule.site)
+        try:
+            if 'store' not in state:
+                state['store'] = open_store(rule.datafile)
+            with METRICS.timer('update_seconds', **labels):
+                update_datafile(rule, session, state['store'], shared=shared, cache=cache, state=state)
+            if rule.threshold:
+                with METRICS.timer('check_seconds', **labels):
+                    check_datafile(rule, state['store'], state)
+            else:
+                if rule.v: print('No Threshold set. PROGRAM END')
+        except Exception as e:
+            METRICS.inc('rule_errors_total', error=type(e).__name__, **labels)
+            print(type(e),e)
+    if cache:
+        cache.evict()
+
+
+def run_daemon(rules, cache=None, session=None, flush=True):
+    # poll -> update -> check every interval minutes, keeping state in memory.
+    # Without flush, metrics are left to the caller, see run_fleet()
+    args = rules[0]
+    if session is None:
+        session = get_session(args.workers, args.rate_limit)
+    states = [{} for rule in rules]
+    while True:
+        tick = monotonic()
+        if args.v: print(f'{"["+args.site+"] " if args.site else ""}TICK: {dt.datetime.now(pytz.UTC).isoformat(timespec="seconds")}')
+        run_rules(rules, session, states, cache)
+        METRICS.observe('run_seconds', monotonic()-tick, site=args.site)
+        if flush:
+            METRICS.flush(args.metrics, args.prometheus)
+        sleep(max(0, 60*args.interval - (monotonic()-tick)))
+
+
+def run_fleet(sites, daemon=False, timeout=None):
+    # run every site in its own thread, so a site stuck on its dashboard or powerstrip
+    # can't hold up the others. Sites on the same dashboard host share its session.
+    # In --daemon mode each site keeps its own polling loop and this flushes their metrics, otherwise this waits up to
+    # `timeout` seconds for the sites' single passes and returns the sites still running
+    threads = {}
+    for rules, cache in sites:
+        args = rules[0]
+        session = get_host_session(args.dashboard, args.workers, args.rate_limit)
+        if daemon:
+            target, target_args = run_daemon, (rules, cache, session, False)
+        else:
+            target, target_args = run_rules, (rules, session, [{} for rule in rules], cache)
+        threads[args.site] = threading.Thread(target=target, args=target_args, name=args.site, daemon=True)
+        threads[args.site].start()
+    if daemon:
+        # METRICS is shared by every site, so it is flushed once for the fleet, every shortest interval
+        args = sites[0][0][0]
+        interval = min(rules[0].interval for rules, cache in sites)
+        while any(thread.is_alive() for thread in threads.values()):
+            sleep(60*interval)
+            METRICS.flush(args.metrics, args.prometheus)
+        return []
+    deadline = monotonic()+timeout if timeout else None
+    for thread in threads.values():
+        thread.join(None if deadline is None else max(0, deadline-monotonic()))
+    return [site for site, thread in threads.items() if thread.is_alive()]
+
+
+def make_sites(args, parser):
+    # one (rules, cache) per --site file. Each file is parsed like --file, on top of
+    # a copy of the arguments given on the command line, and named after the file
+    sites = []
+    for fname in args.sites:
+        site = argparse.Namespace(**vars(args))
+        site.sites = None
+        site.site = os.path.splitext(os.path.basename(fname))[0]
+        with open(fname) as f:
+            parser.parse_args(shlex.split(f.read()), site)
+        if not site.dashboard:
+            parser.error(f'--site {fname} has no --dashboard')
+        if (site.metrics, site.prometheus) != (args.metrics, args.prometheus):
+            parser.error(f'--site {fname} sets --metrics or --prometheus, give them on the command line for the whole fleet')
+        sites.append(setup(site, parser))
+
+    # sites must not share datafiles, logfiles, timerfiles or cursorfiles
+    seen = {}
+    for rules, cache in sites:
+        for rule in rules:
+            for fn in [rule.datafile, rule.logfile, rule.timerfile, rule.cursorfile]:
+                if seen.setdefault(fn, rule.site) != rule.site:
+                    parser.error(f'--site {seen[fn]} and {rule.site} both use {fn}, use {{IFCB}} or per-site file options')
+    # nor an outbox with different email configs, it would send their alerts with one site's login
+    outboxes = {}
+    for rules, cache in sites:
+        config = rules[0].email_config
+        if config and outboxes.setdefault(rules[0].outbox, (config, rules[0].site))[0] != config:
+            parser.error(f'--site {outboxes[rules[0].outbox][1]} and {rules[0].site} use different --email-config '
+                         f'with the same --outbox {rules[0].outbox}, give each its own --outbox')
+    link_peers([rule for rules, cache in sites for rule in rules])
+    return sites
+
+
+def state_files(rule):
+    return [rule.datafile, rule.logfile, rule.timerfile, rule.cursorfile]
+
+
+def lock_state(sites, wait=0):
+    # lock every state directory, in a fixed order so overlapping runs can't deadlock,
+    # then clear out temporary files left by a crash mid-write, there and in the bin caches,
+    # outboxes and Prometheus file's directory. Raises Busy
+    dirs = sorted({os.path.dirname(fn) for rules, cache in sites for rule in rules for fn in state_files(rule)})
+    locks = [StateLock(d).acquire(wait) for d in dirs]
+    others = {rule.outbox for rules, cache in sites for rule in rules if rule.email_config and os.path.isdir(rule.outbox)}
+    others |= {os.path.dirname(rules[0].prometheus) for rules, cache in sites if rules[0].prometheus}
+    caches = {cache.root for rules, cache in sites if cache.root and os.path.isdir(cache.root)}
+    for d, recursive in [(d, False) for d in sorted(set(dirs) | others)]+[(d, True) for d in sorted(caches)]:
+        for path in remove_stale_tmp(d, recursive):
+            print(f'RECOVERY: removed partial write {path}')
+    return locks
+
+
+def recover(rule):
+    # startup check of a rule's state files. Unreadable files are moved aside, the pump
+    # timer is rebuilt from the pump log and the poll cursor from the datafile where possible
+    problem = check_store(rule.datafile)
+    if problem:
+        print(f'RECOVERY: {rule.datafile} unreadable ({problem}), moved to {quarantine(rule.datafile)}')
+
+    df_log = None
+    if os.path.isfile(rule.logfile):
+        try:
+            df_log = pd.read_csv(rule.logfile, index_col='triggering_bin')
+            df_log['pump_back_on'] = pd.to_datetime(df_log['pump_back_on'], errors='coerce')
+        except (ValueError, KeyError) as e:
+            print(f'RECOVERY: {rule.logfile} unreadable ({type(e).__name__}), moved to {quarantine(rule.logfile)}')
+            df_log = None
+
+    try:
+        get_pump_timer(rule.timerfile)
+    except ValueError:
+        # a pump turned off and not yet back on restarts its timer
+        timer = None
+        if df_log is not None and len(df_log) and pd.isna(df_log['pump_back_on'].iloc[-1]):
+            timer = pd.to_datetime(df_log['pump_turned_off'].iloc[-1], errors='coerce')
+            timer = None if pd.isna(timer) else timer
+        aside = quarantine(rule.timerfile)
+        set_pump_timer(rule.timerfile, timer)
+        print(f'RECOVERY: {rule.timerfile} unreadable, moved to {aside}. Pump timer restored to {timer}')
+
+    try:
+        get_poll_cursor(rule.cursorfile)
+    except ValueError:
+        aside = quarantine(rule.cursorfile)
+        latest = open_store(rule.datafile).read()['sample_time'].max()
+        set_poll_cursor(rule.cursorfile, None if pd.isna(latest) else latest)
+        print(f'RECOVERY: {rule.cursorfile} unreadable, moved to {aside}. Poll cursor restored to {latest}')
+
+
+def idle_file(rule):
+    return os.path.splitext(rule.cursorfile)[0]+'.idle.json'
+
+
+def config_key(rule):
+    # fingerprint of a rule's options, so a changed threshold or outlet is never skipped as idle
+    options = {k: v for k, v in vars(rule).items() if k not in ['file', 'peers']}
+    return hashlib.sha1(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def save_idle(rule, state):
+    # after a one-shot pass, record whether the rule was left with nothing to do until new bins
+    # are listed or its next failed bin is due a retry, see idle_run()
+    if state.get('cursor') is None or not state.get('settled', not rule.threshold):
+        return
+    with atomic_open(idle_file(rule)) as f:
+        json.dump(dict(config=config_key(rule), cursor=state['cursor'].isoformat(), retry_at=state['due']), f)
+
+
+def list_sample_times(rule, since):
+    # sample_times of the bins listed since `since`, like list_bins but with only the standard library
+    query = urlencode(dict(dataset=rule.dataset, instrument=rule.ifcb, skip_filter='exclude',
+                           start_date=since.isoformat(timespec='seconds')))
+    with urlopen(f'{rule.dashboard}/api/list_bins?{query}', timeout=rule.http_timeout) as r:
+        return [dt.datetime.fromisoformat(b['sample_time'].replace('Z', '+00:00')) for b in json.load(r)['data']]
+
+
+def rule_idle(rule, now, listed):
+    try:
+        with open(idle_file(rule)) as f:
+            idle = json.load(f)
+        cursor = dt.datetime.fromisoformat(idle['cursor'])
+        if idle['config'] != config_key(rule) or (idle['retry_at'] is not None and idle['retry_at'] <= now.timestamp()):
+            return False
+        since = max(cursor, now-dt.timedelta(days=rule.buffer))
+        if now-since > dt.timedelta(hours=rule.poll_chunk):
+            return False
+        key = (rule.dashboard, rule.dataset, rule.ifcb, since)
+        if key not in listed:
+            listed[key] = list_sample_times(rule, since)
+        return all(t <= cursor for t in listed[key])
+    except (OSError, ValueError, KeyError, TypeError):
+        return False  # left to the full pass, which reports any dashboard errors
+
+
+def idle_run(rules):
+    # whether a one-shot run has nothing to do: each rule's last pass left nothing to switch,
+    # log or retry, and the dashboard lists no bins since. Decided without importing pandas or
+    # requests, which is most of a full pass's cost on a small host. Otherwise the idle files
+    # are removed, as the full pass about to run changes the state they vouch for
+    now = dt.datetime.now(dt.timezone.utc)
+    listed = {}
+    if all(rule_idle(rule, now, listed) for rule in rules):
+        for rule in rules:
+            if len(rules)>1: print('TAXON:', rule.taxon, f'({rule.dataset} {rule.ifcb})')
+            else: print('TAXON:', rule.taxon)
+            if rule.v: print('No new bins: nothing to do')
+        return True
+    for rule in rules:
+        if os.path.exists(idle_file(rule)):
+            os.remove(idle_file(rule))
+    return False
+
+
+def make_rules(args):
+    # one namespace per --rule, each a copy of args with the rule's fields swapped in
+    if not args.rules:
+        return [args]
+    rules = []
+    for dataset, ifcb, taxon, threshold, outlet in args.rules:
+        rule = argparse.Namespace(**vars(args))
+        rule.dataset, rule.ifcb, rule.taxon = dataset, ifcb, taxon
+        rule.threshold = int(threshold)
+        if outlet.lower() in ['none','0']:
+            rule.powerstrip, rule.pump_outlet = None, None  # alert-only rule
+        else:
+            rule.pump_outlet = int(outlet)
+        rules.append(rule)
+    return rules
+
+
+def make_parser():
     parser = argparse.ArgumentParser(description='A CLI tool for monitoring and responding to algal blooms.')
     parser.add_argument('-v', '--verbose', dest='v', action='count', default=0)
+    parser.add_argument('--daemon', action='store_true',
+        help='Keep running, polling the dashboard every --interval minutes.')
+    parser.add_argument('--interval', metavar='MINUTES', default=2, type=float,
+        help='Polling interval in --daemon mode. Default is "2" minutes')
+    parser.add_argument('--site', dest='sites', metavar='FILE', action='append',
+        help='Run a fleet of sites from one process. Each FILE holds one site\'s arguments, as for --file, '
+             'applied over the arguments given here. May be given multiple times. Sites run in parallel, '
+             'each in its own worker, and must not share data, log, timer or cursor files')
+    parser.add_argument('--site-timeout', metavar='SECS', type=float,
+        help='Without --daemon, stop waiting for sites that have not finished after this long')
+    parser.add_argument('--status-port', metavar='PORT', type=int,
+        help='In --daemon mode, serve the latest reading, outlet and timer state, recent history and a '
+             'plot as json over http on this port, at /status, /status/IFCB/TAXON and /plot/IFCB/TAXON.png')
+    parser.add_argument('--status-host', metavar='HOST', default='127.0.0.1',
+        help='Address the --status-port endpoint listens on. Default is "127.0.0.1"')
+    parser.add_argument('--lock-wait', metavar='SECS', default=0, type=float,
+        help='How long to wait for an overlapping run to release the state directories before exiting. Default is "0"')
+    parser.add_argument('--fsync', choices=['always', 'file', 'never'], default='always',
+        help='When state file writes are flushed to disk: "always" the file and its directory entry, '
+             '"file" just its contents, or "never". Default is "always"')
+    parser.set_defaults(site=None, peers=[])
+    parser.add_argument('--metrics', metavar='FILE',
+        help='Append stage timings, counters and HTTP status counts to this file, one json line per run or --daemon tick')
+    parser.add_argument('--prometheus', metavar='FILE',
+        help='Also write running metric totals to this Prometheus text format file, eg for node_exporter\'s textfile collector')
 
     conn = parser.add_argument_group(title='Connection', description=None)
     conn.add_argument('--dashboard', metavar='URL', help='The target ifcb dashboard url.')
     conn.add_argument('--dataset', help='An ifcb dataset.')
     conn.add_argument('--ifcb', metavar='ID', help='Instrument to pull data from.')
+    conn.add_argument('--workers', metavar='N', default=8, type=int,
+        help='Maximum number of concurrent dashboard requests. Default is "8"')
+    conn.add_argument('--http-timeout', metavar='SECS', default=30, type=float,
+        help='Timeout for each dashboard request in seconds. Default is "30"')
+    conn.add_argument('--rate-limit', metavar='N', type=float,
+        help='Most requests per second to a dashboard host, shared by every --site on that host. Default is no limit')
 
     data = parser.add_argument_group(title='Data', description=None)
     data.add_argument('--taxon', default='Margalefidinium',
         help='Taxon to trigger threshold off of. Default is "Margalefidinium"')
     data.add_argument('--threshold', metavar='INT', type=int,
         help='Threshold perL-counts beyond which pump, aerator, and emails are triggered')
+    data.add_argument('--rule', dest='rules', action='append', nargs=5,
+        metavar=('DATASET','ID','TAXON','THRESHOLD','OUTLET'),
+        help='Monitor several dataset/instrument/taxon combinations in one run. May be given '
+             'multiple times and overrides --dataset, --ifcb, --taxon, --threshold and --pump-outlet. '
+             'OUTLET is the pump outlet, or "none". File options may use {IFCB} alongside {TAXON}')
+    data.add_argument('--threshold-off', metavar='INT', type=float,
+        help='Once the pump is off, counts above this (rather than --threshold) keep re-setting the pump timer')
+    data.add_argument('--trigger', choices=MODES, default='last',
+        help='What is compared to the threshold: the latest bin ("last"), a rolling "mean" or "median" '
+             'or an "ewma" over --window bins, or the "rise" in perL per hour over --window bins. Default is "last"')
+    data.add_argument('--window', metavar='BINS', type=int, default=3,
+        help='Number of bins for --trigger modes other than "last". Default is "3"')
     data.add_argument('--datafile', default='data/{TAXON}.csv',
-        help='File to record bin data to. Default is "data/{TAXON}.csv"')
+        help='File to record bin data to. Default is "data/{TAXON}.csv". '
+             'A ".sqlite" or ".db" extension stores bins in an indexed SQLite database instead')
     data.add_argument('--buffer', metavar='DAYS', default=14, type=int,
         help='How many days of recent bins to include. Default is "14" days, ie 2 weeks')
+    data.add_argument('--cursorfile', default='data/.{TAXON}.cursor.txt',
+        help='Records the latest sample_time already ingested, new bins are listed from there. '
+             'Default is "data/.{TAXON}.cursor.txt"')
+    data.add_argument('--cache-dir', metavar='DIR', default='data/cache',
+        help='Directory caching each bin\'s ml_analyzed and class counts, and failed fetches awaiting a retry. '
+             '"none" to only keep failed fetches, in memory. Default is "data/cache"')
+    data.add_argument('--cache-mb', metavar='MB', default=256, type=float,
+        help='Size limit of --cache-dir, oldest entries are evicted first. Default is "256" MB')
+    data.add_argument('--cache-days', metavar='DAYS', type=float,
+        help='Evict cache entries older than this many days. Default is to keep them')
+    data.add_argument('--fetch-limit', metavar='N', default=50, type=int,
+        help='Most bins to fetch per run, newest first, the rest are fetched on later runs. "0" for no limit. Default is "50"')
+    data.add_argument('--retry-minutes', metavar='MINUTES', default=2, type=float,
+        help='Wait before retrying a bin whose fetch failed, eg not yet classified, doubling with each failure. Default is "2"')
+    data.add_argument('--max-attempts', metavar='N', default=12, type=int,
+        help='Give up on a bin once the dashboard has had no ml_analyzed or class scores for it this many times, '
+             '"0" to never give up. Other failures, eg timeouts, are retried indefinitely. Default is "12"')
+    data.add_argument('--poll-chunk', metavar='HOURS', default=24, type=float,
+        help='Longest span of bins to list per dashboard request when catching up. Default is "24" hours')
 
     power = parser.add_argument_group(title='Powerstrip', description=None)
     power.add_argument('--timer', metavar='HOURS', default=1.5, type=float,
@@ -332,6 +1000,10 @@ if __name__ == '__main__':
     power.add_argument('--powerstrip', metavar='URL', help='The url of the network switch.')
     power.add_argument('--powerstrip-auth', nargs=2, metavar=('USER','PASS'),
         help='The login user and password of the network switch.')
+    power.add_argument('--powerstrip-timeout', metavar='SECS', default=7, type=float,
+        help='Timeout for each powerstrip request in seconds. Default is "7"')
+    power.add_argument('--outlet-retry', metavar='MINUTES', default=5, type=float,
+        help='Wait before retrying an outlet switch that failed, doubling with each failure up to an hour. Default is "5"')
     power.add_argument('--pump-outlet', metavar='ID', type=int)
     power.add_argument('--aerator-outlet', metavar='ID', type=int)
     power.add_argument('--logfile', default='data/{TAXON}.pumplog.csv',
@@ -343,6 +1015,12 @@ if __name__ == '__main__':
     alert.add_argument('--emails', metavar='EMAIL', nargs='+')
     alert.add_argument('--email-config', metavar=('SMTP','USER','PASS'), nargs=3)
     alert.add_argument('--plotfile', default='data/emailplot.png')
+    alert.add_argument('--plot-size', metavar=('W','H'), nargs=2, type=float, default=[10,4],
+        help='Size of --plotfile in inches. Default is "10 4"')
+    alert.add_argument('--plot-dpi', metavar='DPI', type=int, default=100,
+        help='Resolution of --plotfile. Default is "100"')
+    alert.add_argument('--outbox', metavar='DIR', default='data/outbox',
+        help='Alert emails are queued here until sent. Default is "data/outbox"')
 
     # alternate method of providing arguments
     class LoadFromFile(argparse.Action):
@@ -352,33 +1030,88 @@ if __name__ == '__main__':
                 parser.parse_args(shlex.split(f.read()), namespace)
     parser.add_argument('--file', type=open, action=LoadFromFile)
 
-    args = parser.parse_args()
-    print('TAXON:',args.taxon)
+    return parser
 
+
+def setup(args, parser):
+    # tidy up parsed arguments, returning one namespace per rule and the bin cache
+    statefiles.FSYNC = args.fsync
     if not args.dashboard.startswith(('https://','http://')):
         args.dashboard = 'https://'+args.dashboard
 
-    def filecheck(fn):
-        fn = fn.format(TAXON=args.taxon)
+    if args.powerstrip and args.powerstrip.lower() in ['none','0']: args.powerstrip = None
+    if args.powerstrip_auth: args.powerstrip_auth = tuple(args.powerstrip_auth)
+
+    rules = make_rules(args)
+    if len({rule.ifcb for rule in rules})>1 and not all('{IFCB}' in fn for fn in [args.datafile, args.logfile, args.timerfile, args.cursorfile]):
+        parser.error('--rule across several instruments requires {IFCB} in --datafile, --logfile, --timerfile and --cursorfile')
+
+    def filecheck(fn, rule):
+        fn = fn.format(TAXON=rule.taxon, IFCB=rule.ifcb)
         os.makedirs(os.path.dirname(fn), exist_ok=True)
         return fn
-    args.logfile = filecheck(args.logfile)
-    args.datafile = filecheck(args.datafile)
-    args.timerfile = filecheck(args.timerfile)
+    for rule in rules:
+        rule.logfile = filecheck(rule.logfile, rule)
+        rule.datafile = filecheck(rule.datafile, rule)
+        rule.timerfile = filecheck(rule.timerfile, rule)
+        rule.cursorfile = filecheck(rule.cursorfile, rule)
+        if rule.pump_outlet: rule.pump_outlet -=1
+        if rule.aerator_outlet: rule.aerator_outlet -=1
+    link_peers(rules)
 
-    if args.powerstrip.lower() in ['none','0']: args.powerstrip = None
-    if args.powerstrip_auth: args.powerstrip_auth = tuple(args.powerstrip_auth)
+    cache_dir = None if args.cache_dir.lower() in ['none','0'] else args.cache_dir
+    cache = BinCache(cache_dir, max_mb=args.cache_mb, max_days=args.cache_days,
+                     retry_minutes=args.retry_minutes, max_attempts=args.max_attempts)
+    return rules, cache
 
-    if args.pump_outlet: args.pump_outlet -=1
-    if args.aerator_outlet: args.aerator_outlet -=1
 
+if __name__ == '__main__':
+    parser = make_parser()
+    args = parser.parse_args()
+    sites = make_sites(args, parser) if args.sites else [setup(args, parser)]
+    outboxes = {(rules[0].outbox, tuple(rules[0].email_config)) for rules, cache in sites if rules[0].email_config}
     try:
-
-        df = update_datafile(args)
-        if args.threshold:
-            check_datafile(args, df)
+        locks = lock_state(sites, args.lock_wait)  # held until exit
+    except Busy as e:
+        parser.exit(1, f'Not running: {e}\n')
+    # a one-shot run with no new bins skips the full pass, and with it the startup checks
+    idle = not args.daemon and not args.sites and idle_run(sites[0][0])
+    if not idle:
+        for rules, cache in sites:
+            for rule in rules:
+                recover(rule)
+
+    if args.daemon:
+        from emailing import get_outbox
+        for outbox, email_config in outboxes:
+            get_outbox(outbox, *email_config).start()
+        if args.status_port:
+            from statusapi import STATUS, serve as serve_status
+            serve_status(STATUS, args.status_host, args.status_port)
+        if args.sites:
+            run_fleet(sites, daemon=True)
         else:
-            if args.v: print('No Threshold set. PROGRAM END')
-
-    except Exception as e:
-        print(type(e),e)
+            run_daemon(*sites[0])
+    else:
+        start = monotonic()
+        if args.sites:
+            stuck = run_fleet(sites, timeout=args.site_timeout)
+            if stuck:
+                print(f'ERROR: sites still running after {args.site_timeout}s: {", ".join(stuck)}')
+        elif idle:
+            METRICS.inc('idle_runs_total')
+        else:
+            rules, cache = sites[0]
+            states = [{} for rule in rules]
+            run_rules(rules, get_session(args.workers, args.rate_limit), states, cache)
+            for rule, state in zip(rules, states):
+                save_idle(rule, state)
+        ALERTS.shutdown(wait=True)
+        for outbox, email_config in outboxes:
+            # also retries anything left queued by earlier runs
+            if os.path.isdir(outbox) and any(fn.endswith('.eml') for fn in os.listdir(outbox)):
+                from emailing import get_outbox
+                get_outbox(outbox, *email_config).flush()
+        METRICS.observe('run_seconds', monotonic()-start)
+        # idle runs leave the Prometheus file with the last full pass's readings
+        METRICS.flush(args.metrics, None if idle else args.prometheus)
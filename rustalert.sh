@@ -2,6 +2,12 @@
 
 ## CRONTAB ENTRY ##
 # */30 * * * * /home/ifcb/github/ifcb_rust/rustalert.sh >> /home/ifcb/github/ifcb_rust/data/rustalert.sh.log 2>&1
+# runs that find no new bins (and nothing to retry) skip pandas entirely, so frequent entries stay cheap
+## DAEMON ALTERNATIVE ##
+# run once (eg from @reboot or a systemd unit) with "--daemon --interval MINUTES" added to params.txt
+## FLEET ##
+# several sites from one process: put each site's arguments in its own file and run
+# rustalert.py --site siteA.txt --site siteB.txt (with {IFCB} in the data, log, timer and cursor file options)
 
 echo "RUNNING rustalert.sh"
 /usr/bin/date -I'seconds'
@@ -0,0 +1,111 @@
+import fcntl
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# when writes are fsynced: "always" the file and its directory entry, "file" only the
+# file's contents, "never" leaving it to the OS. Set from --fsync
+FSYNC = 'always'
+
+
+def fsync_dir(path):
+    fd = os.open(path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_open(fname, mode='w'):
+    # write to a temporary file next to fname, then rename it over fname, so readers
+    # and crashes only ever see the old or the new file, never a partial one
+    tmp = f'{fname}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, mode) as f:
+            yield f
+            if FSYNC != 'never':
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if FSYNC == 'always':
+        fsync_dir(os.path.dirname(fname))
+
+
+class Busy(Exception):
+    pass
+
+
+class StateLock:
+    # exclusive lock on a state directory, held until released or the process exits,
+    # so overlapping runs never read and write the same state files
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory or '.', '.rustalert.lock')
+        self.f = None
+
+    def acquire(self, wait=0):
+        # wait up to `wait` seconds for the lock, raising Busy if another run still holds it
+        self.f = open(self.path, 'a+')
+        deadline = time.monotonic()+wait
+        while True:
+            try:
+                fcntl.flock(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    self.f.seek(0)
+                    holder = self.f.read().strip() or 'unknown'
+                    self.f.close()
+                    self.f = None
+                    raise Busy(f'{self.path} is held by another run (pid {holder})')
+                time.sleep(min(0.5, max(0, deadline-time.monotonic())))
+        self.f.seek(0)
+        self.f.truncate()
+        self.f.write(str(os.getpid()))
+        self.f.flush()
+        return self
+
+    def release(self):
+        if self.f is not None:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+            self.f.close()
+            self.f = None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_stale_tmp(directory, recursive=False):
+    # temporary files atomic_open left behind in a process that has since died, ie a crash mid-write.
+    # Other files are left alone, as are those of running processes
+    removed = []
+    for dirpath, dirnames, filenames in os.walk(directory or '.'):
+        for fn in filenames:
+            m = re.fullmatch(r'.+\.(\d+)\.\d+\.tmp', fn)
+            if m and not _alive(int(m.group(1))):
+                os.remove(os.path.join(dirpath, fn))
+                removed.append(os.path.join(dirpath, fn))
+        if not recursive:
+            break
+    return removed
+
+
+def quarantine(fname):
+    # move an unreadable state file aside, keeping it for inspection
+    aside = f'{fname}.corrupt-{time.strftime("%Y%m%dT%H%M%S")}'
+    os.replace(fname, aside)
+    return aside
@@ -0,0 +1,111 @@
+import datetime as dt
+import json
+import re
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from lazy import LazyModule
+
+pd = LazyModule('pandas')
+
+
+def _jsonable(value):
+    if isinstance(value, (pd.Timestamp, dt.datetime)):
+        return None if pd.isna(value) else value.isoformat()
+    if isinstance(value, float) and value != value:
+        return None
+    if hasattr(value, 'item'):  # numpy scalars
+        return _jsonable(value.item())
+    return value
+
+
+class Status:
+    # the latest reading, outlet and timer state, recent history and alert plot of every rule,
+    # as last seen by check_datafile. Served from memory, so status requests never reach
+    # the dashboard or the powerstrip
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rules = {}
+
+    def update(self, key, summary, history=None):
+        # returns whether the reading or pump log changed since the last update, ie the plot is stale
+        with self.lock:
+            rule = self.rules.setdefault(key, dict(summary={}, history=None, plot=None))
+            stale = any(rule['summary'].get(k) != summary.get(k) for k in ['bin', 'pump_log_entries'])
+            rule['summary'] = summary
+            if history is not None:
+                rule['history'] = history
+            return stale or rule['plot'] is None
+
+    def set_plot(self, key, png):
+        with self.lock:
+            self.rules[key]['plot'] = png
+
+    def summary(self, key):
+        # summary of one rule, with the time left on the pump timer as of now
+        summary = dict(self.rules[key]['summary'])
+        expires = summary.get('timer_expires')
+        now = dt.datetime.now(dt.timezone.utc)
+        summary['timer_remaining_secs'] = max(0, (expires-now).total_seconds()) if expires is not None else None
+        summary['age_secs'] = (now-summary['sample_time']).total_seconds() if summary.get('sample_time') is not None else None
+        return {k: _jsonable(v) for k, v in summary.items()}
+
+    def history(self, key):
+        df = self.rules[key]['history']
+        if df is None:
+            return []
+        return [dict(pid=pid, sample_time=_jsonable(t), taxon_perL=_jsonable(perL))
+                for pid, t, perL in zip(df.index, df['sample_time'], df['taxon_perL'])]
+
+
+class Handler(BaseHTTPRequestHandler):
+    # GET /status                        every rule's summary
+    # GET /status/<ifcb>/<taxon>         one rule's summary and recent history
+    # GET /plot/<ifcb>/<taxon>.png       one rule's latest pre-rendered plot
+
+    timeout = 10  # seconds, so a stalled client only ties up its own thread
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, body, ctype='application/json', code=200):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # the reply is built under the lock but sent after releasing it, so a slow client
+        # never holds up check_datafile's status updates
+        status = self.server.status
+        path = self.path.split('?')[0].rstrip('/')
+        body, ctype, code = dict(error='not found'), 'application/json', 404
+        with status.lock:
+            m_status = re.fullmatch(r'/status/([^/]+/[^/]+)', path)
+            m_plot = re.fullmatch(r'/plot/([^/]+/[^/]+)\.png', path)
+            if path in ['', '/status']:
+                body, code = {key: status.summary(key) for key in status.rules}, 200
+            elif m_status and m_status.group(1) in status.rules:
+                key = m_status.group(1)
+                body, code = dict(status.summary(key), history=status.history(key)), 200
+            elif m_plot and m_plot.group(1) in status.rules and status.rules[m_plot.group(1)]['plot']:
+                body, ctype, code = status.rules[m_plot.group(1)]['plot'], 'image/png', 200
+        self.reply(body, ctype, code)
+
+
+def serve(status, host='127.0.0.1', port=8080):
+    # serve status from a background thread, returns the server
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.status = status
+    threading.Thread(target=server.serve_forever, name='status', daemon=True).start()
+    return server
+
+
+# one status registry per process, filled in by check_datafile
+STATUS = Status()
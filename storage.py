@@ -0,0 +1,169 @@
+import os.path
+import sqlite3
+from contextlib import closing
+
+from lazy import LazyModule
+from statefiles import atomic_open
+
+pd = LazyModule('pandas')
+
+COLUMNS = ['sample_time', 'bin_ml', 'bin_added', 'taxon_count', 'taxon_perL', 'taxon_added']
+TIME_COLUMNS = ['sample_time', 'bin_added', 'taxon_added']
+FLOAT_COLUMNS = ['bin_ml', 'taxon_count', 'taxon_perL']
+
+
+def open_store(fname):
+    # pick a storage backend from the datafile's extension
+    if fname.endswith(('.sqlite', '.db')):
+        return SQLiteStore(fname)
+    return CSVStore(fname)
+
+
+def check_store(fname):
+    # None if the datafile is missing or readable, else what is wrong with it
+    if not os.path.isfile(fname):
+        return None
+    try:
+        if fname.endswith(('.sqlite', '.db')):
+            with closing(sqlite3.connect(fname)) as con:
+                result = con.execute('PRAGMA quick_check').fetchone()[0]
+            return None if result == 'ok' else result
+        df = pd.read_csv(fname, index_col='pid', nrows=1)
+        missing = set(COLUMNS)-set(df.columns)
+        return f'missing columns {", ".join(sorted(missing))}' if missing else None
+    except (ValueError, sqlite3.DatabaseError) as e:
+        return f'{type(e).__name__}: {e}'
+
+
+def empty_bins():
+    df = pd.DataFrame(columns=COLUMNS, dtype=float)
+    df.index.name = 'pid'
+    return df
+
+
+def coerce_types(df):
+    for col in TIME_COLUMNS:
+        df[col] = pd.to_datetime(df[col], utc=True)
+    df[FLOAT_COLUMNS] = df[FLOAT_COLUMNS].astype(float)
+    return df
+
+
+class CSVStore:
+    # the whole datafile is read once, kept in memory and rewritten on save
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.df = None
+
+    def exists(self):
+        return self.df is not None or os.path.isfile(self.fname)
+
+    def _load(self):
+        if self.df is None:
+            try:
+                self.df = pd.read_csv(self.fname, index_col='pid', parse_dates=TIME_COLUMNS)
+            except FileNotFoundError:
+                self.df = empty_bins()
+            self.df = coerce_types(self.df)
+        return self.df
+
+    def read(self, since=None):
+        df = self._load()
+        if since is not None:
+            df = df[df['sample_time'] > since]
+        return df
+
+    def add_bins(self, bin_df):
+        # add newly listed bins, rows already in the store are left untouched
+        df = self._load()
+        new = bin_df[~bin_df.index.isin(df.index)]
+        if not new.empty:
+            self.df = coerce_types(df.combine_first(new.reindex(columns=COLUMNS)))
+
+    def pending(self, since=None):
+        # bins still missing their bin_ml or taxon_count
+        df = self.read(since)
+        return df[df['bin_ml'].isna() | df['taxon_count'].isna()].copy()
+
+    def update(self, rows):
+        df = self._load()
+        df.loc[rows.index, COLUMNS] = rows[COLUMNS]
+        self.df = coerce_types(df)
+
+    def prune(self, before):
+        df = self._load()
+        self.df = df[df['sample_time'] > before]
+
+    def tail_valid(self, n=1):
+        # the latest n bins with a taxon_perL, oldest first
+        df = self._load()
+        df = df[~df['taxon_perL'].isna()]
+        return df.sort_values('sample_time').tail(n)
+
+    def save(self):
+        with atomic_open(self.fname) as f:
+            self._load().sort_index().to_csv(f)
+
+
+class SQLiteStore:
+    # one row per bin, indexed by sample_time. Only new or changed rows are written,
+    # retention is a range delete and the latest reading is an index lookup
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.con = sqlite3.connect(fname)
+        self.con.executescript('''
+            CREATE TABLE IF NOT EXISTS bins (
+                pid TEXT PRIMARY KEY, sample_time TEXT NOT NULL,
+                bin_ml REAL, bin_added TEXT,
+                taxon_count REAL, taxon_perL REAL, taxon_added TEXT);
+            CREATE INDEX IF NOT EXISTS bins_sample_time ON bins (sample_time);
+            CREATE INDEX IF NOT EXISTS bins_valid ON bins (sample_time) WHERE taxon_perL IS NOT NULL;
+        ''')
+
+    def exists(self):
+        return self.con.execute('SELECT 1 FROM bins LIMIT 1').fetchone() is not None
+
+    def _query(self, sql, params=()):
+        df = pd.read_sql_query(sql, self.con, params=params, index_col='pid')
+        return coerce_types(df.reindex(columns=COLUMNS))
+
+    @staticmethod
+    def _records(df):
+        # timestamps as iso text (which sorts chronologically for a fixed utc offset), NaN as NULL
+        df = df.reindex(columns=COLUMNS).astype(object)
+        for col in TIME_COLUMNS:
+            df[col] = [None if pd.isna(t) else SQLiteStore._iso(t) for t in df[col]]
+        df = df.where(df.notna(), None)
+        return list(df.itertuples(name=None))
+
+    @staticmethod
+    def _iso(timestamp):
+        return pd.Timestamp(timestamp).tz_convert('UTC').isoformat(sep=' ')
+
+    def read(self, since=None):
+        if since is None:
+            return self._query('SELECT * FROM bins ORDER BY sample_time')
+        return self._query('SELECT * FROM bins WHERE sample_time > ? ORDER BY sample_time', (self._iso(since),))
+
+    def add_bins(self, bin_df):
+        self.con.executemany('INSERT OR IGNORE INTO bins VALUES (?,?,?,?,?,?,?)', self._records(bin_df))
+
+    def pending(self, since=None):
+        sql = 'SELECT * FROM bins WHERE (bin_ml IS NULL OR taxon_count IS NULL)'
+        if since is None:
+            return self._query(sql)
+        return self._query(sql+' AND sample_time > ?', (self._iso(since),))
+
+    def update(self, rows):
+        self.con.executemany('INSERT OR REPLACE INTO bins VALUES (?,?,?,?,?,?,?)', self._records(rows))
+
+    def prune(self, before):
+        self.con.execute('DELETE FROM bins WHERE sample_time <= ?', (self._iso(before),))
+
+    def tail_valid(self, n=1):
+        df = self._query('SELECT * FROM bins WHERE taxon_perL IS NOT NULL ORDER BY sample_time DESC LIMIT ?', (n,))
+        return df.iloc[::-1]
+
+    def save(self):
+        self.con.commit()
@@ -0,0 +1,37 @@
+from lazy import LazyModule
+
+pd = LazyModule('pandas')
+
+MODES = ['last', 'mean', 'median', 'ewma', 'rise']
+
+
+def history_needed(mode, window):
+    # how many of the latest classified bins trigger_signal() needs for an up to date latest value.
+    # For ewma, older bins weigh in at under e**-8 of the latest
+    return {'last': 1, 'mean': window, 'median': window, 'rise': window+1, 'ewma': 4*window}[mode]
+
+
+def trigger_signal(series, mode='last', window=3):
+    # the values compared against the threshold, from a perL series indexed by sample_time
+    #   last:   each bin's own counts
+    #   mean:   rolling mean over the latest `window` bins
+    #   median: rolling median over the latest `window` bins
+    #   ewma:   exponentially weighted mean with a span of `window` bins
+    #   rise:   change in counts over the latest `window` bins, per hour
+    if mode == 'last':
+        return series
+    elif mode == 'mean':
+        return series.rolling(window, min_periods=1).mean()
+    elif mode == 'median':
+        return series.rolling(window, min_periods=1).median()
+    elif mode == 'ewma':
+        return series.ewm(span=window).mean()
+    elif mode == 'rise':
+        hours = series.index.to_series().diff(window).dt.total_seconds()/3600
+        return series.diff(window)/hours.to_numpy()
+    raise ValueError(f'Unknown trigger mode: {mode}')
+
+
+def perL_series(df):
+    # bins with sample_time and taxon_perL columns as a series indexed by sample_time
+    return pd.Series(df['taxon_perL'].to_numpy(), index=pd.DatetimeIndex(df['sample_time']), name='taxon_perL')